@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Product, Category, Notification, Size, ProductSize, Order
+from .models import Product, Category, Notification, Size, ProductSize, Order, Job, StockMovement
 
 # Register your models here.
 
@@ -20,7 +20,7 @@ class ProductSizeInline(admin.TabularInline):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ["id", 'name']
+    list_display = ["id", 'name', 'total_stock']
     inlines = [ProductSizeInline]
 
 
@@ -28,3 +28,25 @@ class ProductAdmin(admin.ModelAdmin):
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'total_price', 'is_paid',)
     list_display_links = ("id", "user")
+    list_select_related = ('user',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_total()
+
+    @admin.display(description='Total price', ordering='order_total')
+    def total_price(self, obj):
+        return obj.total_price
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'run_at', 'updated_at')
+    list_filter = ('status', 'kind')
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ('id', 'size', 'delta', 'reason', 'order', 'created_at')
+    list_filter = ('reason',)
+    list_select_related = ('size__product', 'size__size')
+    raw_id_fields = ('size', 'order')
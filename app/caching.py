@@ -0,0 +1,156 @@
+"""
+Versioned cache and conditional GET support for catalog responses.
+
+Catalog payloads are the same for every user apart from `liked_by_user`, so
+they are serialized without a user, cached under the current catalog
+version and the like flags are overlaid per request from app.liked_cache.
+Any write to a Category, Product or ProductSize bumps the version (see
+app.signals), which makes every older entry unreachable; the timeout only
+reclaims memory.
+
+ETags combine the cache key with the time of the user's last like toggle,
+and both are read in one query, so a `304 Not Modified` is answered before
+anything is serialized.
+"""
+import calendar
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Subquery
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+from . import liked_cache
+from .models import CatalogVersion, LikeDislike, Order
+
+CATALOG_VERSION_ID = 1
+
+
+def get_catalog_version():
+    version = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).values_list('version', flat=True).first()
+    return version or 0
+
+
+def bump_catalog_version():
+    updated = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID) \
+        .update(version=F('version') + 1, updated_at=timezone.now())
+    if not updated:
+        CatalogVersion.objects.get_or_create(pk=CATALOG_VERSION_ID, defaults={'version': 1})
+
+
+def get_catalog_state(user):
+    """
+    (version, catalog updated_at, time of the user's last like toggle) in one query.
+    """
+    liked_at = LikeDislike.objects.filter(user=user.username).order_by('-updated_at').values('updated_at')[:1]
+    row = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID).annotate(liked_at=Subquery(liked_at)) \
+        .values_list('version', 'updated_at', 'liked_at').first()
+    return row or (0, None, None)
+
+
+def catalog_cache_key(request, scope, version, **extra):
+    """
+    Key for a catalog response: the version, the endpoint scope and every query
+    parameter (category_name, price_filter, search, cursor, ...). The host is
+    included because payloads contain absolute URLs.
+    """
+    params = sorted((key, value) for key in request.query_params for value in request.query_params.getlist(key))
+    params.extend(sorted(extra.items()))
+    raw = f"{request.build_absolute_uri('/')}|{params!r}"
+    return f"catalog:{version}:{scope}:{hashlib.sha1(raw.encode()).hexdigest()}"
+
+
+def cached_catalog_payload(request, scope, build, version=None, **extra):
+    """
+    Return the shared payload for `scope`, building and caching it on a miss.
+    The version is read before building so a concurrent write can only make
+    the stored entry newer than its key, never older.
+    """
+    if version is None:
+        version = get_catalog_version()
+    key = catalog_cache_key(request, scope, version, **extra)
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60))
+    return data
+
+
+def overlay_liked(products, user, liked_at=liked_cache.ANY):
+    """
+    Set `liked_by_user` on serialized products for `user` from the liked cache.
+    """
+    if not products or not user.is_authenticated or 'liked_by_user' not in products[0]:
+        return products
+
+    liked = liked_cache.liked_ids(user.username, liked_at)
+    for product in products:
+        product['liked_by_user'] = product['id'] in liked
+    return products
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest())
+
+
+def not_modified(request, etag, last_modified):
+    """
+    A 304 response if the request's validators match `etag` / `last_modified`, else None.
+    """
+    timestamp = calendar.timegm(last_modified.utctimetuple()) if last_modified else None
+    response = get_conditional_response(request._request, etag=etag, last_modified=timestamp)
+    if response is not None:
+        set_validators(response, etag, last_modified)
+    return response
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(calendar.timegm(last_modified.utctimetuple()))
+    return response
+
+
+def catalog_response(request, scope, build, products, **extra):
+    """
+    Conditional, cached catalog response. `build` serializes the shared
+    payload and `products` picks the product dicts to overlay likes on.
+    """
+    version, updated_at, liked_at = get_catalog_state(request.user)
+    key = catalog_cache_key(request, scope, version, **extra)
+    etag = make_etag(key, liked_at)
+    last_modified = max(filter(None, (updated_at, liked_at)), default=None)
+
+    response = not_modified(request, etag, last_modified)
+    if response is not None:
+        return response
+
+    data = cached_catalog_payload(request, scope, build, version=version, **extra)
+    overlay_liked(products(data), request.user, liked_at)
+    return set_validators(Response(data), etag, last_modified)
+
+
+def active_order_validators(user):
+    """
+    (order id, ETag, Last-Modified) of the user's active order in one query,
+    or None if there is not exactly one. The payload also shows product and
+    stock data, so the catalog version is part of the tag.
+    """
+    catalog = CatalogVersion.objects.filter(pk=CATALOG_VERSION_ID)
+    rows = list(
+        Order.objects.filter(user=user, is_paid=False).annotate(
+            catalog_version=Subquery(catalog.values('version')[:1]),
+            catalog_updated_at=Subquery(catalog.values('updated_at')[:1]),
+        ).values_list('id', 'updated_at', 'catalog_version', 'catalog_updated_at')[:2]
+    )
+    if len(rows) != 1:
+        return None
+
+    order_id, updated_at, catalog_version, catalog_updated_at = rows[0]
+    # The payment link embeds the user's names
+    etag = make_etag(order_id, updated_at.isoformat(), catalog_version,
+                     user.username, user.first_name, user.last_name, user.email)
+    return order_id, etag, max(filter(None, (updated_at, catalog_updated_at)))
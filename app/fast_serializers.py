@@ -0,0 +1,112 @@
+"""
+Fast read path for the hot list endpoints.
+
+Builds the same dicts as ProductSerializer, NotificationSerializer and
+OrderItemSerializer straight from `.values()` rows and one lookup query per
+relation, skipping serializer instantiation and field resolution. The
+output renders to byte-identical JSON (see the parity tests in app.tests).
+Opt-in with `FAST_READ_SERIALIZERS` (off by default); requests using sparse fieldsets
+(?fields= / ?expand=) always take the serializer path.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from rest_framework import serializers
+
+from .models import Product, ProductSize, OrderItem
+from .serializers import query_list
+
+_datetime = serializers.DateTimeField()
+_image_storage = Product._meta.get_field('image').storage
+
+# SimpleProductSerializer.get_image
+IMAGE_BASE_URL = "https://darkslied.pythonanywhere.com"
+
+
+def enabled(request):
+    if not getattr(settings, 'FAST_READ_SERIALIZERS', False):
+        return False
+    return not (query_list(request, 'fields') or query_list(request, 'expand'))
+
+
+def product_values(queryset):
+    """Product rows as dicts, keeping annotations such as is_liked and search_rank."""
+    return queryset.prefetch_related(None).values()
+
+
+def image_url(name, request):
+    if not name:
+        return None
+    url = _image_storage.url(name)
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def products(rows, request):
+    """ProductSerializer(many=True) for product_values() rows."""
+    sizes = defaultdict(list)
+    size_rows = ProductSize.objects.filter(product_id__in=[row['id'] for row in rows]).order_by('id') \
+        .values_list('id', 'product_id', 'size__name', 'count')
+    for pk, product_id, size_name, count in size_rows:
+        sizes[product_id].append({'id': pk, 'size_name': size_name, 'count': count, 'is_available': count > 0})
+
+    return [{
+        'id': row['id'],
+        'category': row['category_id'],
+        'name': row['name'],
+        'price': float(row['price']),
+        'sizes': sizes[row['id']],
+        'description': row['description'],
+        'image': image_url(row['image'], request),
+        'total_count': row['total_stock'],
+        'liked_by_user': bool(row.get('is_liked', False)),
+    } for row in rows]
+
+
+def notification_values(queryset):
+    """Rows of a Notification.objects.with_viewed() queryset."""
+    return queryset.prefetch_related(None).values('id', 'title', 'message', 'created_at', 'has_viewed')
+
+
+def notifications(rows, request):
+    """NotificationSerializer(many=True) for notification_values() rows."""
+    return [{
+        'id': row['id'],
+        'title': row['title'],
+        'message': row['message'],
+        'created_at': _datetime.to_representation(row['created_at']),
+        'has_viewed': bool(row['has_viewed']),
+    } for row in rows]
+
+
+def order_items(order):
+    """OrderItemSerializer(many=True) for the items of `order`."""
+    rows = OrderItem.objects.filter(order=order).order_by('id').values_list(
+        'id', 'quantity', 'product_id', 'product__name', 'product__price', 'product__image',
+        'product__description', 'size_id', 'size__size__name', 'size__count',
+    )
+    return [{
+        'order_item_id': pk,
+        'product': {
+            'id': product_id,
+            'name': name,
+            'price': float(price),
+            'image': IMAGE_BASE_URL + _image_storage.url(image) if image else None,
+            'description': description,
+        },
+        'size': {'id': size_id, 'size_name': size_name},
+        'quantity': quantity,
+        'available_stock': count,
+        'total_price': quantity * price,
+    } for pk, quantity, product_id, name, price, image, description, size_id, size_name, count in rows]
+
+
+def order(obj):
+    """OrderSerializer for the Order `obj`."""
+    return {
+        'id': obj.id,
+        'user': obj.user_id,
+        'items': order_items(obj),
+        'created_at': _datetime.to_representation(obj.created_at),
+        'is_paid': obj.is_paid,
+        'total_price': obj.total_price,
+    }
@@ -0,0 +1,84 @@
+"""
+Background job handlers, run by `manage.py run_jobs`.
+
+The Payme webhook only records the event and enqueues a job in the same
+transaction (see PaymeCallBackAPIView); order fulfilment runs here. Jobs
+run at least once, so every handler checks the current state first and
+is safe to repeat.
+"""
+import traceback
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from payme.models import PaymeTransactions
+
+from .models import Job, Order, OrderItem
+
+HANDLERS = {}
+
+
+def handler(kind):
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def run(job):
+    try:
+        HANDLERS[job.kind](**job.payload)
+    except Exception:
+        job.fail(traceback.format_exc())
+        return False
+    job.finish()
+    return True
+
+
+def work(limit=10, lease=300):
+    """
+    Claim and run one batch of due jobs. Returns (run, failed).
+    """
+    jobs = Job.claim(limit, lease)
+    failed = sum(not run(job) for job in jobs)
+    return len(jobs), failed
+
+
+@handler('fulfil_order')
+def fulfil_order(transaction_id):
+    """Deduct stock for a performed Payme transaction and tell the customer."""
+    payment = PaymeTransactions.get_by_transaction_id(transaction_id=transaction_id)
+    if payment.state != PaymeTransactions.SUCCESSFULLY:
+        return  # Cancelled before it was fulfilled
+
+    order = Order.objects.get(id=payment.account_id)
+    if order.is_paid:
+        return  # An earlier attempt got through
+    # The notification is queued with the deduction, a crash in between would lose it on retry
+    with transaction.atomic():
+        OrderItem.deduct_stock(order)
+        Job.enqueue('notify_order_paid', order_id=order.pk)
+
+
+@handler('refund_order')
+def refund_order(transaction_id):
+    """Put back the stock of a cancelled, performed Payme transaction."""
+    payment = PaymeTransactions.get_by_transaction_id(transaction_id=transaction_id)
+    if payment.state == PaymeTransactions.CANCELED:
+        # No-op for orders that were never fulfilled
+        OrderItem.restore_stock(Order.objects.get(id=payment.account_id))
+
+
+@handler('notify_order_paid')
+def notify_order_paid(order_id):
+    """Telegram message to the customer; usernames are Telegram ids."""
+    token = getattr(settings, 'TELEGRAM_BOT_TOKEN', '')
+    if not token:
+        return
+
+    order = Order.objects.select_related('user').get(pk=order_id)
+    response = requests.post(f"https://api.telegram.org/bot{token}/sendMessage", timeout=10, data={
+        'chat_id': order.user.username,
+        'text': f"Buyurtma #{order.pk} uchun to'lov qabul qilindi. Rahmat!",
+    })
+    response.raise_for_status()
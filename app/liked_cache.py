@@ -0,0 +1,63 @@
+"""
+Per-process cache of the product ids each user likes.
+
+Holds a frozenset of liked product ids per user (keyed by username, the
+Telegram id), so rendering `liked_by_user` for a page is a set lookup per
+row. At most LIKED_CACHE_SIZE users are kept, least recently used first
+out. LikeProductView drops the toggling user's entry in its own process.
+Callers pass the time of the user's last like toggle (catalog responses
+read it anyway, others use last_toggle()) and an entry loaded before it
+is reloaded, so toggles made through other processes are seen at once.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import LikeDislike
+
+ANY = object()  # liked_ids(): accept an entry whatever its liked_at
+
+_entries = OrderedDict()  # username -> (loaded at, time of the last toggle, liked ids)
+_lock = threading.Lock()
+
+
+def liked_ids(username, liked_at=ANY):
+    """
+    The ids of the products `username` likes. `liked_at` is the time of
+    the user's last toggle when the caller knows it.
+    """
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(username)
+        if entry is not None and now - entry[0] < getattr(settings, 'LIKED_CACHE_TTL', 60) \
+                and (liked_at is ANY or entry[1] == liked_at):
+            _entries.move_to_end(username)
+            return entry[2]
+
+    rows = list(LikeDislike.objects.filter(user=username).values_list('product_id', 'is_like', 'updated_at'))
+    ids = frozenset(product_id for product_id, is_like, _ in rows if is_like)
+    latest = max((updated_at for _, _, updated_at in rows), default=None)
+    with _lock:
+        _entries[username] = (now, latest, ids)
+        _entries.move_to_end(username)
+        while len(_entries) > getattr(settings, 'LIKED_CACHE_SIZE', 10000):
+            _entries.popitem(last=False)
+    return ids
+
+
+def last_toggle(username):
+    """Time of the user's last like toggle, one query on the (user, updated_at) index."""
+    return LikeDislike.objects.filter(user=username).order_by('-updated_at') \
+        .values_list('updated_at', flat=True).first()
+
+
+def invalidate(username):
+    with _lock:
+        _entries.pop(username, None)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
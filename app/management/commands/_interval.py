@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+
+class IntervalCommand(BaseCommand):
+    """
+    A maintenance command that runs once, or keeps running and repeats every --interval seconds.
+
+    Subclasses implement sweep(), which does one pass and returns (changed, report); the report
+    is written on every pass that changed something, and always when running once.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running and repeat every INTERVAL seconds")
+
+    def sweep(self, **options):
+        raise NotImplementedError
+
+    def handle(self, *args, **options):
+        while True:
+            changed, report = self.sweep(**options)
+            if changed or not options['interval']:
+                self.stdout.write(report)
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
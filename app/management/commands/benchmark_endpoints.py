@@ -0,0 +1,231 @@
+import base64
+import json
+import statistics
+import subprocess
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from app import urls
+from app.models import Product, ProductSize, LikeDislike, Order, OrderItem, Notification
+
+
+def route_names(patterns):
+    """Names of every route in `patterns`, following includes, in order."""
+    names = []
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            names.extend(name for name in route_names(pattern.url_patterns) if name not in names)
+        elif isinstance(pattern, URLPattern) and pattern.name and pattern.name not in names:
+            names.append(pattern.name)
+    return names
+
+
+def percentile(samples, percent):
+    if len(samples) == 1:
+        return samples[0]
+    return statistics.quantiles(samples, n=100, method='inclusive')[percent - 1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Benchmark every route of app.urls on the current database and write latency percentiles, "
+            "query counts and response sizes to a JSON report. Writes are rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument('--cold', action='store_true', help="Clear the cache before every request")
+        parser.add_argument('--output', help="Write the JSON report to this file")
+        parser.add_argument('--compare', help="Baseline JSON report to compare against")
+        parser.add_argument('--threshold', type=float, default=20.0,
+                            help="Allowed p95 slowdown in percent before a route counts as a regression")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            cases = self.build_cases()
+            missing = [name for name in route_names(urls.urlpatterns) if name not in {case[1] for case in cases}]
+            report = {
+                'commit': git_commit(),
+                'created_at': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'iterations': options['iterations'],
+                'cold': options['cold'],
+                'data': {
+                    'products': Product.objects.count(),
+                    'users': User.objects.count(),
+                    'likes': LikeDislike.objects.count(),
+                    'orders': Order.objects.count(),
+                    'notifications': Notification.objects.count(),
+                },
+                'routes': {},
+                'not_covered': missing,
+            }
+            for label, _, method, path, data, headers in cases:
+                report['routes'][label] = self.run_case(method, path, data, headers, options)
+            transaction.set_rollback(True)
+
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(report, file, indent=2)
+        if options['compare']:
+            with open(options['compare']) as file:
+                regressions = self.compare(json.load(file), report, options['threshold'])
+            if regressions:
+                raise CommandError(f"Regressions in: {', '.join(regressions)}")
+
+    def build_cases(self):
+        """
+        (label, route name, method, path, data, headers) for every route,
+        against a throwaway user with likes and an active order.
+        """
+        sizes = list(ProductSize.objects.filter(count__gte=2).select_related('product').order_by('id')[:3])
+        notification = Notification.objects.order_by('id').first()
+        if len(sizes) < 3 or notification is None:
+            raise CommandError("Not enough data, run manage.py seed_catalog first")
+        product = sizes[0].product
+
+        user = User.objects.create(username=f"benchmark-{time.time_ns()}", first_name="Benchmark")
+        token = Token.objects.create(user=user)
+        products = list(Product.objects.order_by('id')[:20])
+        LikeDislike.objects.bulk_create([LikeDislike(user=user.username, product=item, is_like=True) for item in products])
+
+        order = Order.objects.create(user=user)
+        items = [OrderItem.objects.create(order=order, product=size.product, size=size, quantity=1)
+                 for size in sizes[1:]]
+        new_size = sizes[0]
+
+        auth = {'HTTP_AUTHORIZATION': f'Token {token.key}'}
+        payme = base64.b64encode(f"Paycom:{settings.PAYME_KEY}".encode()).decode()
+        payme_body = {
+            'id': 1,
+            'method': 'CheckPerformTransaction',
+            'params': {'amount': int(order.total_price * 100), 'account': {settings.PAYME_ACCOUNT_FIELD: order.id}},
+        }
+        category = product.category_id
+        return [
+            ('api-root', 'api-root', 'get', reverse('api-root'), None, auth),
+            ('product-list', 'product-list', 'get', reverse('product-list'), None, auth),
+            ('product-list?price_filter', 'product-list', 'get',
+             reverse('product-list') + '?price_filter=aasc', None, auth),
+            ('product-list?popular', 'product-list', 'get',
+             reverse('product-list') + '?price_filter=popular', None, auth),
+            ('product-list?search', 'product-list', 'get',
+             reverse('product-list') + '?search=' + product.name.split()[0], None, auth),
+            ('product-detail', 'product-detail', 'get', reverse('product-detail', args=[product.pk]), None, auth),
+            ('user_login', 'user_login', 'get', reverse('user_login') + f'?tg-id={user.username}', None, {}),
+            ('category-products', 'category-products', 'get',
+             reverse('category-products', args=[category]), None, auth),
+            ('all-categories', 'all-categories', 'get', reverse('all-categories'), None, auth),
+            ('like_product', 'like_product', 'post', reverse('like_product', args=[product.pk]), None, auth),
+            ('like_status', 'like_status', 'get', reverse('like_status') + '?ids=' + ','.join(
+                str(pk) for pk in Product.objects.order_by('id').values_list('id', flat=True)[:20]), None, auth),
+            ('liked-products', 'liked-products', 'get', reverse('liked-products'), None, auth),
+            ('add_order_item', 'add_order_item', 'post', reverse('add_order_item'),
+             {'product_id': new_size.product_id, 'size_id': new_size.pk, 'quantity': 1}, auth),
+            ('remove_order_item', 'remove_order_item', 'delete',
+             reverse('remove_order_item', args=[items[0].pk]), None, auth),
+            ('update_order_item', 'update_order_item', 'patch', reverse('update_order_item'),
+             {'order_item_id': items[-1].pk, 'quantity': 2}, auth),
+            ('batch_order_items', 'batch_order_items', 'post', reverse('batch_order_items'), {'operations': [
+                {'op': 'add', 'size_id': new_size.pk, 'quantity': 1},
+                {'op': 'update', 'order_item_id': items[-1].pk, 'quantity': 2},
+                {'op': 'remove', 'order_item_id': items[0].pk},
+            ]}, auth),
+            ('get_active_order', 'get_active_order', 'get', reverse('get_active_order'), None, auth),
+            ('notifications', 'notifications', 'get', reverse('notifications'), None, auth),
+            ('unread_notification_count', 'unread_notification_count', 'get',
+             reverse('unread_notification_count'), None, auth),
+            ('mark_all_notifications_read', 'mark_all_notifications_read', 'post',
+             reverse('mark_all_notifications_read'), None, auth),
+            ('get_notification_and_mark_read', 'get_notification_and_mark_read', 'get',
+             reverse('get_notification_and_mark_read', args=[notification.pk]), None, auth),
+            ('payment_callback', 'payment_callback', 'post', reverse('payment_callback'), payme_body,
+             {'HTTP_AUTHORIZATION': f'Basic {payme}'}),
+            ('update_payment_callback', 'update_payment_callback', 'get',
+             reverse('update_payment_callback') + f'?order_id={order.pk}', None, auth),
+            ('wait_payment_status', 'wait_payment_status', 'get',
+             reverse('wait_payment_status') + f'?order_id={order.pk}&timeout=0', None, auth),
+        ]
+
+    def run_case(self, method, path, data, headers, options):
+        client = Client()
+        request = getattr(client, method)
+        kwargs = {'data': json.dumps(data), 'content_type': 'application/json'} if data is not None else {}
+        timings, queries, sizes, statuses = [], [], [], set()
+
+        for i in range(options['warmup'] + options['iterations']):
+            if options['cold']:
+                cache.clear()
+            savepoint = transaction.savepoint()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = request(path, **kwargs, **headers)
+                elapsed = time.perf_counter() - start
+            transaction.savepoint_rollback(savepoint)
+
+            if i >= options['warmup']:
+                timings.append(elapsed * 1000)
+                queries.append(len(context.captured_queries))
+                sizes.append(len(response.content))
+                statuses.add(response.status_code)
+
+        return {
+            'method': method.upper(),
+            'path': path,
+            'status': sorted(statuses),
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'mean_ms': round(statistics.fmean(timings), 3),
+            'queries': statistics.median_low(queries),
+            'bytes': statistics.median_low(sizes),
+        }
+
+    def print_report(self, report):
+        self.stdout.write(f"{'route':<34}{'status':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+                          f"{'queries':>9}{'bytes':>9}")
+        for label, result in report['routes'].items():
+            status = ','.join(map(str, result['status']))
+            self.stdout.write(f"{label:<34}{status:>8}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}"
+                              f"{result['p99_ms']:>9.2f}{result['queries']:>9}{result['bytes']:>9}")
+        if report['not_covered']:
+            self.stdout.write(self.style.WARNING(f"Routes without a case: {', '.join(report['not_covered'])}"))
+
+    def compare(self, baseline, report, threshold):
+        """
+        Print the change of every route against `baseline` and return the
+        routes whose p95 grew by more than `threshold` percent or that run
+        more queries.
+        """
+        self.stdout.write(f"\nAgainst {baseline.get('commit') or 'baseline'}:")
+        regressions = []
+        for label, result in report['routes'].items():
+            before = baseline['routes'].get(label)
+            if before is None:
+                continue
+            change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+            queries = result['queries'] - before['queries']
+            regressed = change > threshold or queries > 0
+            line = f"{label:<34}p95 {change:>+7.1f}%  queries {queries:>+3}  bytes {result['bytes'] - before['bytes']:>+7}"
+            self.stdout.write(self.style.ERROR(line) if regressed else line)
+            if regressed:
+                regressions.append(label)
+        return regressions
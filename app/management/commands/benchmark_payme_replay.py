@@ -0,0 +1,58 @@
+import base64
+import json
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from app.models import PaymeEvent
+
+
+class Command(BaseCommand):
+    help = ("Replay duplicate Payme PerformTransaction / CancelTransaction deliveries against ledgers "
+            "of growing size and report latency and queries per delivery. Everything is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help="Ledger sizes to measure at")
+        parser.add_argument('--deliveries', type=int, default=500, help="Duplicate deliveries per ledger size")
+
+    def handle(self, *args, **options):
+        client = Client()
+        auth = base64.b64encode(f"Paycom:{settings.PAYME_KEY}".encode()).decode()
+        url = reverse('payment_callback')
+
+        self.stdout.write(f"{'ledger rows':>12}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}")
+        with transaction.atomic():
+            created = 0
+            for size in sorted(options['events']):
+                PaymeEvent.objects.bulk_create([
+                    PaymeEvent(transaction_id=f"replay-{i // 2}", method=(PaymeEvent.PERFORM, PaymeEvent.CANCEL)[i % 2],
+                               result={'result': {'transaction': f"replay-{i // 2}", 'state': 2}})
+                    for i in range(created, size)
+                ], batch_size=1000)
+                created = max(created, size)
+
+                timings, queries = [], []
+                for i in range(options['deliveries']):
+                    event = (i * 7919) % created  # Spread over the whole ledger
+                    body = {
+                        'id': i,
+                        'method': (PaymeEvent.PERFORM, PaymeEvent.CANCEL)[event % 2],
+                        'params': {'id': f"replay-{event // 2}", 'reason': 5},
+                    }
+                    with CaptureQueriesContext(connection) as context:
+                        start = time.perf_counter()
+                        client.post(url, json.dumps(body), content_type='application/json',
+                                    HTTP_AUTHORIZATION=f'Basic {auth}')
+                        timings.append((time.perf_counter() - start) * 1000)
+                    queries.append(len(context.captured_queries))
+
+                p50, p95, p99 = (statistics.quantiles(timings, n=100, method='inclusive')[p - 1] for p in (50, 95, 99))
+                self.stdout.write(f"{created:>12}{p50:>9.3f}{p95:>9.3f}{p99:>9.3f}{max(queries):>9}")
+            transaction.set_rollback(True)
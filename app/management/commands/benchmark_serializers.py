@@ -0,0 +1,58 @@
+import timeit
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from app import fast_serializers
+from app.models import Product, Notification, Order
+from app.serializers import ProductSerializer, NotificationSerializer, OrderItemSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare the DRF serializers with the fast .values() path on the current database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help="Rows per payload")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        user = User.objects.first()
+        if user is None:
+            raise CommandError("No users, seed the database first")
+
+        request = Request(APIRequestFactory().get('/api/products/'))
+        request.user = user
+        context = {'request': request}
+
+        products = Product.objects.for_listing().order_by('id')[:rows]
+        notifications = Notification.objects.with_viewed(user).order_by('-created_at', '-id')[:rows]
+        order = Order.objects.filter(items__isnull=False).first()
+
+        cases = [
+            ('products',
+             lambda: ProductSerializer(products.all(), many=True, context=context).data,
+             lambda: fast_serializers.products(list(fast_serializers.product_values(products.all())), request)),
+            ('notifications',
+             lambda: NotificationSerializer(notifications.all(), many=True, context=context).data,
+             lambda: fast_serializers.notifications(
+                 list(fast_serializers.notification_values(notifications.all())), request)),
+        ]
+        if order is not None:
+            cases.append((
+                'order items',
+                lambda: OrderItemSerializer(order.items.all(), many=True).data,
+                lambda: fast_serializers.order_items(order),
+            ))
+
+        renderer = JSONRenderer()
+        self.stdout.write(f"{'payload':<15}{'serializer ms':>15}{'fast ms':>10}{'speedup':>10}  parity")
+        for name, slow, fast in cases:
+            same = renderer.render(slow()) == renderer.render(fast())
+            slow_ms = min(timeit.repeat(slow, number=1, repeat=repeat)) * 1000
+            fast_ms = min(timeit.repeat(fast, number=1, repeat=repeat)) * 1000
+            self.stdout.write(f"{name:<15}{slow_ms:>15.2f}{fast_ms:>10.2f}{slow_ms / fast_ms:>9.1f}x  "
+                              f"{'ok' if same else 'MISMATCH'}")
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, OperationalError
+
+from app.models import Category, Size, Product, ProductSize, Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = ("Confirm orders for one hot size from concurrent threads, with and without sharded stock, and report "
+            "checkouts per second. Commits its own fixture rows and deletes them afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+        parser.add_argument('--orders', type=int, default=50, help="Orders confirmed per thread")
+        parser.add_argument('--shards', type=int, default=8)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'shards':>7}{'threads':>8}{'orders/s':>10}{'retries':>9}")
+        for shards in (1, options['shards']):
+            for threads in options['threads']:
+                rate, retries = self.run(shards, threads, options['orders'])
+                self.stdout.write(f"{shards:>7}{threads:>8}{rate:>10.1f}{retries:>9}")
+
+    def run(self, shards, threads, per_thread):
+        category = Category.objects.create(name='benchmark_stock_shards')
+        user = User.objects.create(username=f'benchmark-stock-shards-{time.time_ns()}')
+        try:
+            product = Product.objects.create(category=category, name='Flash sale', price=1000, description='...')
+            size = ProductSize.objects.create(product=product, size=Size.objects.get_or_create(name='S')[0],
+                                              count=threads * per_thread)
+            size.shard(shards)
+            orders = Order.objects.bulk_create([Order(user=user) for _ in range(threads * per_thread)])
+            OrderItem.objects.bulk_create([  # No holds, like carts whose holds have lapsed
+                OrderItem(order=order, product=product, size=size, quantity=1) for order in orders
+            ])
+
+            barrier = threading.Barrier(threads + 1)
+            retries = []
+
+            def confirm(batch):
+                barrier.wait()
+                try:
+                    for order in batch:
+                        while True:
+                            try:
+                                OrderItem.deduct_stock(order)
+                                break
+                            except OperationalError:  # SQLite allows one writer at a time
+                                retries.append(order.pk)
+                                time.sleep(0.001)
+                finally:
+                    connection.close()
+
+            workers = [threading.Thread(target=confirm, args=(orders[i::threads],)) for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            return len(orders) / elapsed, len(retries)
+        finally:
+            category.delete()
+            user.delete()
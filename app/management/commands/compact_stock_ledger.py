@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.utils import timezone
+
+from app.models import StockSnapshot
+
+from ._interval import IntervalCommand
+
+
+class Command(IntervalCommand):
+    help = "Fold stock ledger movements into per-size snapshots, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', type=int, default=None,
+                            help="Also delete folded movements older than this many days")
+        super().add_arguments(parser)
+
+    def sweep(self, **options):
+        compacted = StockSnapshot.compact()
+        pruned = 0
+        if options['keep_days'] is not None:
+            pruned = StockSnapshot.prune(timezone.now() - timedelta(days=options['keep_days']))
+        return compacted or pruned, f"Compacted {compacted} sizes, pruned {pruned} movements"
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app.models import ProductSize
+
+
+class Command(BaseCommand):
+    help = ("Spread the stock of sharded sizes evenly over their shards again. With --size and --shards, "
+            "turn sharded mode on for the given sizes, change their number of shards, or turn it off with --shards 1")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, nargs='+', help="ProductSize ids, defaults to every sharded size")
+        parser.add_argument('--shards', type=int, help="Number of shards, defaults to the current number")
+
+    def handle(self, *args, **options):
+        if options['size']:
+            sizes = ProductSize.objects.filter(pk__in=options['size'])
+            if options['shards'] is None:
+                sizes = sizes.filter(shards__gt=0)
+        elif options['shards'] is not None:
+            raise CommandError("--shards needs --size")
+        else:
+            sizes = ProductSize.objects.filter(shards__gt=0)
+
+        for size in sizes.select_related('product', 'size').order_by('id'):
+            total = size.shard(options['shards'] or size.shards)
+            self.stdout.write(f"#{size.pk} {size}: {total} over {size.shards or 1} shards")
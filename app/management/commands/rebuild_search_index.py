@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from app import search
+from app.caching import bump_catalog_version
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text product search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        total = search.rebuild_index(batch_size=options['batch_size'])
+        bump_catalog_version()  # Cached search results may change
+        if search.fts_enabled():
+            self.stdout.write(self.style.SUCCESS(f"Indexed {total} products"))
+        else:
+            self.stdout.write(self.style.WARNING("Full-text search is not available on this database, "
+                                                 "searches use icontains"))
@@ -0,0 +1,54 @@
+from django.db.models import F
+from django.core.management.base import BaseCommand
+
+from app.caching import bump_catalog_version
+from app.models import Product, ProductSize, StockMovement, StockShard
+
+
+class Command(BaseCommand):
+    help = ("Find products whose stored total_stock drifted from the sum of their sizes, and sizes whose count "
+            "drifted from the stock ledger, and repair them")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report drift, don't repair it")
+
+    def handle(self, *args, **options):
+        # The count of a sharded size is a copy of its shards refreshed after commit on a best-effort
+        # basis, so a missed refresh must not look like drift
+        sharded = list(ProductSize.objects.filter(shards__gt=0).values_list('pk', flat=True))
+        if sharded:
+            StockShard.refresh_totals(sharded)
+
+        self.reconcile_ledger(options['dry_run'])
+
+        drifted = Product.objects.annotate(expected=Product.stock_sum()).exclude(total_stock=F('expected'))
+        rows = list(drifted.values_list('id', 'name', 'total_stock', 'expected'))
+
+        for pk, name, stored, expected in rows:
+            self.stdout.write(f"#{pk} {name}: stored {stored}, actual {expected}")
+
+        if not rows:
+            self.stdout.write(self.style.SUCCESS("No drift found"))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f"{len(rows)} products drifted"))
+        else:
+            fixed = Product.refresh_total_stock([row[0] for row in rows])
+            bump_catalog_version()
+            self.stdout.write(self.style.SUCCESS(f"Repaired {fixed} products"))
+
+    def reconcile_ledger(self, dry_run):
+        # The count is what sales are checked against, so drift is booked into the ledger
+        drifted = ProductSize.objects.annotate(expected=ProductSize.ledger_count()).exclude(count=F('expected'))
+        rows = list(drifted.values_list('id', 'count', 'expected'))
+
+        for pk, count, expected in rows:
+            self.stdout.write(f"Size #{pk}: count {count}, ledger {expected}")
+
+        if rows and dry_run:
+            self.stdout.write(self.style.WARNING(f"{len(rows)} sizes drifted from the ledger"))
+        elif rows:
+            StockMovement.objects.bulk_create([
+                StockMovement(size_id=pk, delta=count - expected, reason=StockMovement.ADJUST)
+                for pk, count, expected in rows
+            ])
+            self.stdout.write(self.style.SUCCESS(f"Booked {len(rows)} ledger adjustments"))
@@ -0,0 +1,16 @@
+from app.models import Product
+
+from ._interval import IntervalCommand
+
+
+class Command(IntervalCommand):
+    help = "Snapshot product like counts into the popular ordering, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true',
+                            help="Recount likes from scratch first, repairing drifted counters")
+        super().add_arguments(parser)
+
+    def sweep(self, **options):
+        changed = Product.refresh_popularity(recount=options['recount'])
+        return changed, f"Re-ranked {changed} products"
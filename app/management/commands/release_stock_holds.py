@@ -0,0 +1,15 @@
+from app.models import StockHold
+
+from ._interval import IntervalCommand
+
+
+class Command(IntervalCommand):
+    help = "Delete expired cart stock holds in batches, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        super().add_arguments(parser)
+
+    def sweep(self, **options):
+        released = StockHold.release_expired(options['batch_size'])
+        return released, f"Released {released} expired holds"
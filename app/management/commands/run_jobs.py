@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import jobs
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the database queue until stopped, or until none is due with --once"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run until no job is due, then exit")
+        parser.add_argument('--batch-size', type=int, default=10)
+        parser.add_argument('--lease', type=int, default=300,
+                            help="Seconds before a job claimed by a dead worker is run again")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        while True:
+            ran, failed = jobs.work(options['batch_size'], options['lease'])
+            if ran:
+                self.stdout.write(f"Ran {ran} jobs, {failed} failed")
+            elif options['once']:
+                return
+            else:
+                time.sleep(options['sleep'])
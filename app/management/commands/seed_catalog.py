@@ -0,0 +1,108 @@
+import random
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from app import search
+from app.caching import bump_catalog_version
+from app.models import Category, Size, Product, ProductSize, LikeDislike, Order, OrderItem, Notification, \
+    StockMovement
+
+SIZE_NAMES = ['XS', 'S', 'M', 'L', 'XL', 'XXL', '38', '39', '40', '41', '42', '43']
+WORDS = ["ko'ylak", 'shim', 'kurtka', 'futbolka', 'krossovka', 'sumka', 'qalpoq', 'paypoq',
+         'qizil', "ko'k", 'qora', 'oq', 'yashil', 'paxta', 'charm', 'yozgi', "qishki", 'sport']
+
+
+class Command(BaseCommand):
+    help = "Seed a synthetic catalog, users, likes, orders and notifications for benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--sizes', type=int, default=5, help="Sizes per product")
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--likes', type=int, default=2000)
+        parser.add_argument('--orders', type=int, default=200)
+        parser.add_argument('--notifications', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, the same seed gives the same data")
+
+    def text(self, words):
+        return ' '.join(self.random.choice(WORDS) for _ in range(words))
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        batch = 1000
+
+        categories = Category.objects.bulk_create([
+            Category(name=f"{self.text(1).capitalize()} {i}") for i in range(options['categories'])
+        ])
+        sizes = list(Size.objects.all()) or Size.objects.bulk_create([Size(name=name) for name in SIZE_NAMES])
+
+        products = Product.objects.bulk_create([
+            Product(
+                category=self.random.choice(categories),
+                name=self.text(3).capitalize(),
+                price=self.random.randrange(10, 2000) * 1000,
+                description=self.text(self.random.randint(10, 60)),
+            )
+            for _ in range(options['products'])
+        ], batch_size=batch)
+        per_product = min(options['sizes'], len(sizes))
+        ProductSize.objects.bulk_create([
+            ProductSize(product=product, size=size, count=self.random.randint(0, 50))
+            for product in products
+            for size in self.random.sample(sizes, per_product)
+        ], batch_size=batch)
+        StockMovement.objects.bulk_create([
+            StockMovement(size_id=pk, delta=count, reason=StockMovement.ADJUST)
+            for pk, count in ProductSize.objects.filter(product__in=products, count__gt=0).values_list('pk', 'count')
+        ], batch_size=batch)
+
+        first_id = 900000000 + User.objects.count()
+        users = User.objects.bulk_create([
+            User(username=str(first_id + i), first_name=f"User {i}") for i in range(options['users'])
+        ])
+        Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+
+        pairs = {(self.random.choice(users).username, self.random.choice(products).pk)
+                 for _ in range(options['likes'])}
+        LikeDislike.objects.bulk_create([
+            LikeDislike(user=user, product_id=product_id, is_like=self.random.random() < 0.9)
+            for user, product_id in pairs
+        ], batch_size=batch, ignore_conflicts=True)
+
+        orders = Order.objects.bulk_create([
+            Order(user=self.random.choice(users), is_paid=self.random.random() < 0.7)
+            for _ in range(options['orders'])
+        ])
+        product_sizes = list(ProductSize.objects.filter(product__category__in=categories).select_related('product'))
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=size.product, size=size, quantity=self.random.randint(1, 3))
+            for order in orders
+            for size in self.random.sample(product_sizes, min(self.random.randint(1, 5), len(product_sizes)))
+        ], batch_size=batch)
+
+        notifications = Notification.objects.bulk_create([
+            Notification(title=self.text(4).capitalize(), message=self.text(30))
+            for _ in range(options['notifications'])
+        ])
+        Viewed = Notification.viewed_by_user.through
+        Viewed.objects.bulk_create([
+            Viewed(notification=notification, user=user)
+            for notification in notifications
+            for user in self.random.sample(users, len(users) // 2)
+        ], batch_size=batch, ignore_conflicts=True)
+
+        # bulk_create skips the signals that maintain derived data
+        Product.objects.filter(category__in=categories).update(total_stock=Product.stock_sum())
+        Product.refresh_popularity(recount=True)
+        search.rebuild_index()
+        bump_catalog_version()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(categories)} categories, {len(products)} products, {len(users)} users, "
+            f"{len(pairs)} likes, {len(orders)} orders and {len(notifications)} notifications"
+        ))
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:05
+
+import app.models
+from django.db import migrations, models
+
+
+def randomize_shuffle_keys(apps, schema_editor):
+    # AddField evaluates the callable default once, so existing rows share a key
+    Product = apps.get_model('app', 'Product')
+    products = list(Product.objects.only('id'))
+    for product in products:
+        product.shuffle_key = app.models.random_shuffle_key()
+    Product.objects.bulk_update(products, ['shuffle_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_notification_viewed_by_user_alter_product_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='shuffle_key',
+            field=models.PositiveIntegerField(default=app.models.random_shuffle_key, editable=False),
+        ),
+        migrations.RunPython(randomize_shuffle_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['shuffle_key', 'id'], name='product_shuffle_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+import re
+
+from django.db import migrations, OperationalError
+
+# Copied from app.search as of this migration, so later changes there don't alter it
+FTS_TABLE = 'app_product_fts'
+APOSTROPHES = re.compile(r"['`´ʻʼ‘’]")
+
+
+def normalize(text):
+    return APOSTROPHES.sub('', text or '').lower()
+
+
+def create_product_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    Product = apps.get_model('app', 'Product')
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                "name, description, "
+                "tokenize=\"unicode61 remove_diacritics 2\", prefix='2 3')"
+            )
+        except OperationalError:  # SQLite built without FTS5, search falls back to icontains
+            return
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)",
+            [(pk, normalize(name), normalize(description))
+             for pk, name, description in Product.objects.values_list('id', 'name', 'description')]
+        )
+
+
+def drop_product_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_product_fts, drop_product_fts),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:08
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_total_stock(apps, schema_editor):
+    Product = apps.get_model('app', 'Product')
+    ProductSize = apps.get_model('app', 'ProductSize')
+    total = ProductSize.objects.filter(product=OuterRef('pk')).values('product') \
+        .annotate(total=Sum('count')).values('total')
+    Product.objects.update(total_stock=Coalesce(Subquery(total), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_product_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='total_stock',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_total_stock, migrations.RunPython.noop),
+    ]
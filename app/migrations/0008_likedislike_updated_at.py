@@ -0,0 +1,29 @@
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def create_catalog_version(apps, schema_editor):
+    # Conditional catalog requests need the row to exist
+    CatalogVersion = apps.get_model('app', 'CatalogVersion')
+    CatalogVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_catalog_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='likedislike',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='likedislike',
+            index=models.Index(fields=['user', 'updated_at'], name='likedislike_user_updated_idx'),
+        ),
+        migrations.RunPython(create_catalog_version, migrations.RunPython.noop),
+    ]
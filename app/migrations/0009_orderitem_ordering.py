@@ -0,0 +1,17 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:13
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_likedislike_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='orderitem',
+            options={'ordering': ['id']},
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_orderitem_ordering'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('expires_at', models.DateTimeField()),
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='hold', to='app.orderitem')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='app.order')),
+                ('size', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holds', to='app.productsize')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['size', 'expires_at'], name='stockhold_size_expiry_idx'), models.Index(fields=['expires_at'], name='stockhold_expiry_idx')],
+            },
+        ),
+    ]
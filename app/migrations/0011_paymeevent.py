@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_stockhold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_id', models.CharField(max_length=50)),
+                ('method', models.CharField(choices=[('PerformTransaction', 'PerformTransaction'), ('CancelTransaction', 'CancelTransaction')], max_length=32)),
+                ('result', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('transaction_id', 'method'), name='paymeevent_delivery_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def open_ledger(apps, schema_editor):
+    # Current counts become each size's opening movement
+    ProductSize = apps.get_model('app', 'ProductSize')
+    StockMovement = apps.get_model('app', 'StockMovement')
+    StockMovement.objects.bulk_create([
+        StockMovement(size_id=pk, delta=count, reason='adjust')
+        for pk, count in ProductSize.objects.filter(count__gt=0).values_list('pk', 'count').iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField()),
+                ('position', models.BigIntegerField(default=0)),
+                ('taken_at', models.DateTimeField(auto_now=True)),
+                ('size', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='snapshot', to='app.productsize')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('reason', models.CharField(choices=[('sale', 'Sale'), ('refund', 'Refund'), ('adjust', 'Adjustment')], max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='app.order')),
+                ('size', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='movements', to='app.productsize')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['size', 'id'], name='stockmovement_size_id_idx')],
+            },
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productsize',
+            name='shards',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('size', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='app.productsize')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('size', 'slot'), name='stockshard_size_slot_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:38
+
+from django.db import migrations, models
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_like_counts(apps, schema_editor):
+    Product = apps.get_model('app', 'Product')
+    LikeDislike = apps.get_model('app', 'LikeDislike')
+    likes = LikeDislike.objects.filter(product=OuterRef('pk'), is_like=True).order_by().values('product') \
+        .annotate(total=Count('pk')).values('total')
+    Product.objects.update(like_count=Coalesce(Subquery(likes), 0))
+    Product.objects.update(popularity=F('like_count'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_stock_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='popularity',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['popularity', 'id'], name='product_popularity_idx'),
+        ),
+        migrations.RunPython(fill_like_counts, migrations.RunPython.noop),
+    ]
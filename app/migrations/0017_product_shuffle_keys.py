@@ -0,0 +1,55 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:04
+
+import random
+
+import app.models
+from django.db import migrations, models
+
+
+def randomize_shuffle_keys(apps, schema_editor):
+    # AddField evaluates the callable default once, so existing rows share a key
+    Product = apps.get_model('app', 'Product')
+    fields = ['shuffle_key_1', 'shuffle_key_2', 'shuffle_key_3']
+    products = list(Product.objects.only('id'))
+    for product in products:
+        for field in fields:
+            setattr(product, field, random.randrange(2 ** 31))
+    Product.objects.bulk_update(products, fields, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_unread_notifications'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='shuffle_key_1',
+            field=models.PositiveIntegerField(default=app.models.random_shuffle_key, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='shuffle_key_2',
+            field=models.PositiveIntegerField(default=app.models.random_shuffle_key, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='shuffle_key_3',
+            field=models.PositiveIntegerField(default=app.models.random_shuffle_key, editable=False),
+        ),
+        migrations.RunPython(randomize_shuffle_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['shuffle_key_1', 'id'], name='product_shuffle_1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['shuffle_key_2', 'id'], name='product_shuffle_2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['shuffle_key_3', 'id'], name='product_shuffle_3_idx'),
+        ),
+    ]
@@ -1,11 +1,32 @@
+import random
+import uuid
+from datetime import timedelta
+from functools import partial
+
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models import Sum
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import Count, Max, Sum, Exists, OuterRef, Prefetch, Subquery, Value, F, Q, Case, When, ExpressionWrapper
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.utils import timezone
+
+from . import order_events
 
 # Create your models here.
 
 
+class CatalogVersion(models.Model):
+    """
+    Single row counting catalog writes. Bumped whenever a Category, Product
+    or ProductSize changes; cached catalog responses are keyed on it.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Catalog v{self.version}"
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100)
 
@@ -24,6 +45,44 @@ class Size(models.Model):
         return self.name
 
 
+SHUFFLE_KEY_SPACE = 2 ** 31
+# Independent random orders of the feed, a seed walks one of them (see app.pagination.shuffle_offset)
+SHUFFLE_KEYS = ('shuffle_key', 'shuffle_key_1', 'shuffle_key_2', 'shuffle_key_3')
+
+
+def random_shuffle_key():
+    """Random position of a product in the shuffled feed."""
+    return random.randrange(SHUFFLE_KEY_SPACE)
+
+
+class ProductQuerySet(models.QuerySet):
+    def for_listing(self, user=None, fields=None, expand=(), liked=False):
+        """
+        Prefetch sizes and annotate the user's like flag, so ProductSerializer
+        can render a page without per-row queries. Without a user every
+        product is rendered as `liked`, for callers that know the flag up
+        front. `fields` and `expand` mirror the serializer's sparse
+        fieldsets, so unused relations are not loaded.
+        """
+        queryset = self
+        if not fields or 'sizes' in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch('productsize_set', queryset=ProductSize.objects.select_related('size').order_by('id'))
+            )
+        if fields and 'description' not in fields:
+            queryset = queryset.defer('description')
+        if 'category' in expand:
+            queryset = queryset.select_related('category')
+
+        if user is not None and user.is_authenticated:
+            liked = LikeDislike.objects.filter(product=OuterRef('pk'), user=user.username, is_like=True)
+            queryset = queryset.annotate(is_liked=Exists(liked))
+        else:
+            # Shared payload, like flags are overlaid per user (see app.caching)
+            queryset = queryset.annotate(is_liked=Value(liked))
+        return queryset
+
+
 class Product(models.Model):
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
@@ -31,10 +90,53 @@ class Product(models.Model):
     sizes = models.ManyToManyField(Size, through='ProductSize')
     description = models.TextField()
     image = models.ImageField(upload_to='products/', null=True)
+    shuffle_key = models.PositiveIntegerField(default=random_shuffle_key, editable=False)
+    shuffle_key_1 = models.PositiveIntegerField(default=random_shuffle_key, editable=False)
+    shuffle_key_2 = models.PositiveIntegerField(default=random_shuffle_key, editable=False)
+    shuffle_key_3 = models.PositiveIntegerField(default=random_shuffle_key, editable=False)
+    # Sum of ProductSize.count, maintained by refresh_total_stock()
+    total_stock = models.PositiveIntegerField(default=0, editable=False)
+    # Users liking the product, maintained by LikeDislike.toggle()
+    like_count = models.PositiveIntegerField(default=0, editable=False)
+    # like_count as of the last refresh_popularity(), read by the popular ordering
+    popularity = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = ProductQuerySet.as_manager()
 
     def total_count(self):
-        total = self.productsize_set.aggregate(total=Sum('count'))['total']
-        return total if total else 0
+        return self.total_stock
+
+    @staticmethod
+    def stock_sum():
+        """Subquery computing a product's total stock from its sizes."""
+        total = ProductSize.objects.filter(product=OuterRef('pk')).values('product') \
+            .annotate(total=Sum('count')).values('total')
+        return Coalesce(Subquery(total), 0)
+
+    @staticmethod
+    def refresh_total_stock(product_ids):
+        """
+        Recompute total_stock for the given products in a single UPDATE.
+        """
+        return Product.objects.filter(pk__in=product_ids).update(total_stock=Product.stock_sum())
+
+    @staticmethod
+    def refresh_popularity(recount=False):
+        """
+        Copy like_count into popularity, the snapshot the popular ordering
+        pages over, so pages stay stable between refreshes. With `recount`
+        like_count is first recomputed from LikeDislike, repairing drift
+        from likes written in bulk. Returns the number of products changed.
+        """
+        from .caching import bump_catalog_version
+        if recount:
+            likes = LikeDislike.objects.filter(product=OuterRef('pk'), is_like=True).order_by().values('product') \
+                .annotate(total=Count('pk')).values('total')
+            Product.objects.update(like_count=Coalesce(Subquery(likes), 0))
+        changed = Product.objects.exclude(popularity=F('like_count')).update(popularity=F('like_count'))
+        if changed:
+            bump_catalog_version()
+        return changed
 
     def __str__(self):
         return self.name
@@ -42,27 +144,149 @@ class Product(models.Model):
     class Meta:
         verbose_name_plural = 'Products'
         verbose_name = 'Product'
+        indexes = [
+            models.Index(fields=['shuffle_key', 'id'], name='product_shuffle_idx'),
+            models.Index(fields=['shuffle_key_1', 'id'], name='product_shuffle_1_idx'),
+            models.Index(fields=['shuffle_key_2', 'id'], name='product_shuffle_2_idx'),
+            models.Index(fields=['shuffle_key_3', 'id'], name='product_shuffle_3_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['popularity', 'id'], name='product_popularity_idx'),
+        ]
 
 
 class ProductSize(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     size = models.ForeignKey(Size, on_delete=models.CASCADE)
     count = models.PositiveIntegerField()
+    # Number of StockShard rows holding the stock, 0 when `count` holds it (see StockShard)
+    shards = models.PositiveSmallIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"{self.product.name} - {self.size.name}"
 
+    def available_count(self, exclude_order=None):
+        """
+        Stock not held by live cart reservations, optionally ignoring the holds of `exclude_order`.
+        """
+        held = StockHold.objects.holding(self.pk, exclude_order).aggregate(total=Sum('quantity'))['total']
+        count = self.count
+        if self.shards:
+            count = self.stock_shards.aggregate(total=Sum('count'))['total'] or 0
+        return count - (held or 0)
+
+    def save(self, *args, **kwargs):
+        # Changes made through save() (admin edits, new sizes) go into the stock ledger
+        with transaction.atomic():
+            previous = ProductSize.objects.filter(pk=self.pk).values_list('count', flat=True).first() \
+                if self.pk else None
+            super().save(*args, **kwargs)
+            delta = self.count - (previous or 0)
+            if delta:
+                StockMovement.objects.create(size=self, delta=delta, reason=StockMovement.ADJUST)
+                if self.shards:
+                    self.shard(self.shards, self.count)
+
+    def shard(self, shards, total=None):
+        """
+        Spread the stock evenly over `shards` StockShard rows, or keep it in
+        `count` when `shards` is 1 or less. `total` defaults to the current
+        stock, so calling this with the current number rebalances the shards.
+        """
+        with transaction.atomic():
+            current = list(StockShard.objects.select_for_update().filter(size=self).values_list('count', flat=True))
+            if total is None:
+                total = sum(current) if self.shards else ProductSize.objects.get(pk=self.pk).count
+            StockShard.objects.filter(size=self).delete()
+            shards = shards if shards > 1 else 0
+            StockShard.objects.bulk_create([
+                StockShard(size=self, slot=slot, count=total // shards + (slot < total % shards))
+                for slot in range(shards)
+            ])
+            ProductSize.objects.filter(pk=self.pk).update(count=total, shards=shards)
+            Product.refresh_total_stock([self.product_id])
+        self.count, self.shards = total, shards
+        return total
+
+    @staticmethod
+    def ledger_count():
+        """Expression deriving a size's stock from its last snapshot plus the movements since."""
+        since = StockMovement.objects.filter(size=OuterRef('pk'), pk__gt=Coalesce(OuterRef('snapshot__position'), 0)) \
+            .order_by().values('size').annotate(total=Sum('delta')).values('total')
+        return Coalesce(F('snapshot__count'), 0) + Coalesce(Subquery(since), 0)
+
 
 class LikeDislike(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     user = models.CharField(max_length=100)
     is_like = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)  # Part of the user's catalog ETag
 
     def __str__(self):
         return f'{self.product} {self.is_like}'
 
+    @staticmethod
+    def toggle(user, product_id):
+        """
+        Flip `user`'s like of a product with one upsert and return the new
+        state, or None when the product doesn't exist. The first toggle likes.
+        The product's like_count follows in the same transaction.
+        """
+        quote = connection.ops.quote_name
+        table = quote(LikeDislike._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({quote('product_id')}, {quote('user')}, {quote('is_like')}, "
+                f"{quote('updated_at')}) "
+                f"SELECT {quote('id')}, %s, %s, %s FROM {quote(Product._meta.db_table)} WHERE {quote('id')} = %s "
+                f"ON CONFLICT ({quote('user')}, {quote('product_id')}) DO UPDATE "
+                f"SET {quote('is_like')} = NOT {table}.{quote('is_like')}, "
+                f"{quote('updated_at')} = excluded.{quote('updated_at')} "
+                f"RETURNING {quote('is_like')}",
+                [user, True, connection.ops.adapt_datetimefield_value(timezone.now()), product_id],
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            liked = bool(row[0])
+            products = Product.objects.filter(pk=product_id)
+            if liked:
+                products.update(like_count=F('like_count') + 1)
+            else:
+                products.filter(like_count__gt=0).update(like_count=F('like_count') - 1)
+        return liked
+
+    @staticmethod
+    def liked_ids(user, product_ids):
+        """The ids among `product_ids` that `user` likes, from the (user, product) unique index."""
+        return set(LikeDislike.objects.filter(user=user, is_like=True, product_id__in=product_ids)
+                   .values_list('product_id', flat=True))
+
     class Meta:
         unique_together = ('user', 'product')
+        indexes = [
+            models.Index(fields=['user', 'updated_at'], name='likedislike_user_updated_idx'),
+        ]
+
+
+def line_total():
+    """quantity * product price of an OrderItem row, as a float."""
+    return ExpressionWrapper(F('quantity') * F('product__price'), output_field=models.FloatField())
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_total(self):
+        """
+        Annotate `order_total`, the sum of the order's lines computed in SQL.
+        Order.total_price returns it without querying the items.
+        """
+        totals = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order') \
+            .annotate(total=Sum(line_total())).values('total')
+        return self.annotate(order_total=Coalesce(Subquery(totals), 0.0, output_field=models.FloatField()))
+
+    def with_items(self):
+        """Prefetch the items with their product and size, for OrderSerializer."""
+        items = OrderItem.objects.select_related('product', 'size__size').order_by('id')
+        return self.prefetch_related(Prefetch('items', queryset=items))
 
 
 class Order(models.Model):
@@ -71,12 +295,19 @@ class Order(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_paid = models.BooleanField(default=False)
 
+    objects = OrderQuerySet.as_manager()
+
     def __str__(self):
         return f"Order #{self.id} by {self.user.username}"
 
     @property
     def total_price(self):
-        return sum(item.quantity * item.product.price for item in self.items.all())
+        """
+        The `order_total` annotation when loaded through with_total(), else one aggregate query.
+        """
+        if hasattr(self, 'order_total'):
+            return self.order_total
+        return self.items.aggregate(total=Sum(line_total()))['total'] or 0.0
 
 
 class OrderItem(models.Model):
@@ -88,55 +319,507 @@ class OrderItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.product.name} ({self.size.size.name})"
 
+    class Meta:
+        ordering = ['id']  # Cart lines in the order they were added
+
     def clean(self):
         """
-        Validate that there's enough stock for the specified size and quantity.
+        Validate that there's enough stock for the specified size and quantity,
+        counting what other carts hold.
         """
-        if self.quantity > self.size.count:
+        available = self.size.available_count(exclude_order=self.order_id)
+        if self.quantity > available:
             raise ValueError(
                 f"Not enough stock for {self.size.size.name} of {self.product.name}. "
-                f"Only {self.size.count} items available."
+                f"Only {available} items available."
             )
 
     def save(self, *args, **kwargs):
         """
-        Validate stock but don't modify it yet.
+        Validate stock and hold it for the cart, but don't modify it yet.
         """
-        self.clean()  # Ensure stock validation
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            # Lock the size so concurrent carts see each other's holds
+            ProductSize.objects.select_for_update().filter(pk=self.size_id).exists()
+            self.clean()  # Ensure stock validation
+            super().save(*args, **kwargs)
+            StockHold.place(self)
+
+    @staticmethod
+    def stock_lines(order):
+        """
+        The order's quantity per size with the size's current stock and what
+        other carts hold of it, in one query.
+        """
+        return list(
+            order.items.order_by()
+            .values('size_id', 'size__product_id', 'size__shards', 'size__size__name', 'size__product__name')
+            .annotate(
+                quantity=Sum('quantity'),
+                stock=Case(
+                    When(size__shards=0, then=F('size__count')),
+                    default=Coalesce(Subquery(StockShard.total_for(OuterRef('size_id'))), 0),
+                ),
+                held=Coalesce(Subquery(StockHold.objects.held_for(OuterRef('size_id'), order.pk)), 0),
+            )
+        )
+
+    @staticmethod
+    def move_stock(lines, sign, order=None):
+        """
+        Add `sign * quantity` to every size in `lines` with a single UPDATE
+        and record the movements of `order` in the stock ledger. Deductions
+        only touch sizes that still have the quantity on top of what carts
+        other than `order` hold, so the number of moved lines tells whether
+        every line fit.
+
+        Sharded sizes are moved on their StockShard rows instead; their
+        count, product total and the catalog version are refreshed after
+        commit so the transaction doesn't lock those rows.
+        """
+        plain = [line for line in lines if not line['size__shards']]
+        sharded = [line for line in lines if line['size__shards']]
+        updated = 0
+        if plain:
+            condition = Q(pk__in=[line['size_id'] for line in plain])
+            if sign < 0:
+                held = Coalesce(Subquery(StockHold.objects.held_for(OuterRef('pk'), order)), 0)
+                condition = Q()
+                for line in plain:
+                    condition |= Q(pk=line['size_id'], count__gte=held + line['quantity'])
+            updated = ProductSize.objects.filter(condition).update(count=Case(
+                *(When(pk=line['size_id'], then=F('count') + sign * line['quantity']) for line in plain),
+                default=F('count'),
+                output_field=models.PositiveIntegerField(),
+            ))
+        for line in sharded:
+            if sign < 0:
+                updated += StockShard.take(line['size_id'], line['size__shards'], line['quantity'])
+            else:
+                updated += StockShard.put(line['size_id'], line['size__shards'], line['quantity'])
+        if sharded:
+            # Best effort, a refresh lost to a lock is redone by the next one or rebalance_stock_shards
+            size_ids = [line['size_id'] for line in sharded]
+            transaction.on_commit(lambda: StockShard.refresh_totals(size_ids), robust=True)
+        if updated == len(lines):
+            reason = StockMovement.SALE if sign < 0 else StockMovement.REFUND
+            StockMovement.objects.bulk_create([
+                StockMovement(size_id=line['size_id'], delta=sign * line['quantity'], reason=reason, order_id=order)
+                for line in lines
+            ])
+
+        if plain:
+            # The bulk UPDATE skips the ProductSize signals
+            from .caching import bump_catalog_version
+            Product.refresh_total_stock({line['size__product_id'] for line in plain})
+            bump_catalog_version()
+        return updated
 
     @staticmethod
     def deduct_stock(order):
         """
         Deduct stock for all items in the given order. Call this after payment is successful.
-        """
-        if order.is_paid:
-            raise ValueError("Stock already deducted for this order.")
 
-        for item in order.items.all():
-            if item.quantity > item.size.count:
-                raise ValueError(
-                    f"Not enough stock for {item.size.size.name} of {item.product.name}."
-                )
-            item.size.count -= item.quantity
-            item.size.save()
+        Runs in one transaction with a fixed number of queries. Marking the
+        order paid is the first write, so a concurrent confirmation of the
+        same order fails instead of deducting twice, and the conditional
+        UPDATE never takes stock that is below zero or held by another
+        cart. Any error rolls back both.
+        """
+        with transaction.atomic():
+            claimed = Order.objects.filter(pk=order.pk, is_paid=False).update(is_paid=True, updated_at=timezone.now())
+            if not claimed:
+                raise ValueError("Stock already deducted for this order.")
+
+            lines = OrderItem.stock_lines(order)
+            for line in lines:
+                if line['quantity'] > line['stock'] - line['held']:
+                    raise ValueError(
+                        f"Not enough stock for {line['size__size__name']} of {line['size__product__name']}."
+                    )
+            if lines and OrderItem.move_stock(lines, -1, order.pk) != len(lines):
+                # Another order took the stock after it was read
+                raise ValueError("Not enough stock for this order.")
+            # The stock is taken now, the holds have done their job
+            StockHold.objects.filter(order=order.pk).delete()
+            # Wake clients long-polling the payment status
+            transaction.on_commit(partial(order_events.notify_paid, order.pk))
         order.is_paid = True  # Mark the order as paid
-        order.save()
 
     @staticmethod
     def restore_stock(order):
         """
         Restore stock for all items in the given order. Call this if payment is canceled.
-        """
-        # if not order.is_paid:
-        #     raise ValueError("Stock has not been deducted for this order.")
 
-        for item in order.items.all():
-            # Restore stock for each item
-            item.size.count += item.quantity
-            item.size.save()
+        Only paid orders hold deducted stock; for an unpaid order this does
+        nothing and returns False.
+        """
+        with transaction.atomic():
+            released = Order.objects.filter(pk=order.pk, is_paid=True).update(is_paid=False, updated_at=timezone.now())
+            if not released:
+                return False
+
+            lines = OrderItem.stock_lines(order)
+            if lines:
+                OrderItem.move_stock(lines, 1, order.pk)
         order.is_paid = False  # Mark the order as unpaid
-        order.save()
+        return True
+
+
+class StockHoldQuerySet(models.QuerySet):
+    def live(self):
+        return self.filter(expires_at__gt=timezone.now())
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
+
+    def holding(self, size, exclude_order=None):
+        """Live holds on `size` (an id or OuterRef), optionally without those of `exclude_order`."""
+        holds = self.live().filter(size=size)
+        if exclude_order is not None:
+            holds = holds.exclude(order=exclude_order)
+        return holds
+
+    def held_by_size(self, size_ids, exclude_order=None):
+        """{size id: live held quantity} for `size_ids` in one query."""
+        holds = self.live().filter(size__in=size_ids)
+        if exclude_order is not None:
+            holds = holds.exclude(order=exclude_order)
+        return dict(holds.order_by().values('size').annotate(total=Sum('quantity')).values_list('size', 'total'))
+
+    def held_for(self, size, exclude_order=None):
+        """Total quantity of holding(), as a one-row `total` values queryset for Subquery."""
+        return self.holding(size, exclude_order).order_by().values('size') \
+            .annotate(total=Sum('quantity')).values('total')
+
+
+class StockHold(models.Model):
+    """
+    Stock reserved by a line of an unpaid order until `expires_at`.
+
+    Saving an OrderItem places or refreshes its hold; availability is the
+    size's count minus the live holds of other orders, read through the
+    (size, expires_at) index. Expired holds simply stop counting and are
+    deleted in batches by `manage.py release_stock_holds`.
+    """
+    item = models.OneToOneField(OrderItem, on_delete=models.CASCADE, related_name='hold')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='holds')
+    size = models.ForeignKey(ProductSize, on_delete=models.CASCADE, related_name='holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    objects = StockHoldQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.quantity} x {self.size} until {self.expires_at:%H:%M}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['size', 'expires_at'], name='stockhold_size_expiry_idx'),
+            models.Index(fields=['expires_at'], name='stockhold_expiry_idx'),
+        ]
+
+    @staticmethod
+    def expiry():
+        return timezone.now() + timedelta(seconds=getattr(settings, 'STOCK_HOLD_TTL', 15 * 60))
+
+    @staticmethod
+    def place(item):
+        """Hold `item.quantity` of its size for STOCK_HOLD_TTL seconds from now."""
+        StockHold.objects.update_or_create(item=item, defaults={
+            'order_id': item.order_id, 'size_id': item.size_id, 'quantity': item.quantity,
+            'expires_at': StockHold.expiry(),
+        })
+
+    @staticmethod
+    def place_many(items):
+        """place() for many items with one upsert."""
+        expires_at = StockHold.expiry()
+        StockHold.objects.bulk_create(
+            [StockHold(item=item, order_id=item.order_id, size_id=item.size_id, quantity=item.quantity,
+                       expires_at=expires_at) for item in items],
+            update_conflicts=True, unique_fields=['item'], update_fields=['size', 'quantity', 'expires_at'],
+        )
+
+    @staticmethod
+    def release_expired(batch_size=1000):
+        """
+        Delete expired holds, `batch_size` rows per statement. Returns the number deleted.
+        """
+        total = 0
+        while True:
+            ids = list(StockHold.objects.expired().order_by('expires_at').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return total
+            total += StockHold.objects.filter(pk__in=ids).delete()[0]
+
+
+class StockShard(models.Model):
+    """
+    Part of the stock of a size in sharded mode, for flash-sale sizes that
+    every checkout hits at once. Checkouts decrement one random shard, so
+    concurrent ones mostly lock different rows, and spill over to the other
+    shards when it runs short. The size's `count` becomes a sum of the
+    shards refreshed after every commit. Turn it on and rebalance with
+    `manage.py rebalance_stock_shards`.
+
+    Shards only guarantee stock never goes below zero; the holds of other
+    carts are checked against the sum when the order's lines are read.
+    """
+    size = models.ForeignKey(ProductSize, on_delete=models.CASCADE, related_name='stock_shards')
+    slot = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField()
+
+    def __str__(self):
+        return f"{self.size} #{self.slot}: {self.count}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['size', 'slot'], name='stockshard_size_slot_unique'),
+        ]
+
+    @staticmethod
+    def total_for(size):
+        """Sum of the shards of `size` (an id or OuterRef), as a one-row `total` values queryset for Subquery."""
+        return StockShard.objects.filter(size=size).order_by().values('size') \
+            .annotate(total=Sum('count')).values('total')
+
+    @staticmethod
+    def take(size_id, shards, quantity):
+        """
+        Take `quantity` from a random shard, or piece by piece from all of
+        them starting at that one when it has too little. Returns whether
+        everything was taken; on False the caller rolls back what was.
+        """
+        start = random.randrange(shards)
+        if StockShard.objects.filter(size=size_id, slot=start, count__gte=quantity) \
+                .update(count=F('count') - quantity):
+            return True
+
+        remaining = quantity
+        rows = StockShard.objects.filter(size=size_id, count__gt=0).values_list('pk', 'slot', 'count')
+        for pk, slot, count in sorted(rows, key=lambda row: (row[1] - start) % shards):
+            part = min(count, remaining)
+            if StockShard.objects.filter(pk=pk, count__gte=part).update(count=F('count') - part):
+                remaining -= part
+                if not remaining:
+                    return True
+        return False
+
+    @staticmethod
+    def put(size_id, shards, quantity):
+        """Add `quantity` to a random shard."""
+        return bool(StockShard.objects.filter(size=size_id, slot=random.randrange(shards))
+                    .update(count=F('count') + quantity))
+
+    @staticmethod
+    def refresh_totals(size_ids):
+        """Copy the shard sums into `count` and the product totals of the given sizes."""
+        from .caching import bump_catalog_version
+        sizes = ProductSize.objects.filter(pk__in=size_ids, shards__gt=0)
+        sizes.update(count=Coalesce(Subquery(StockShard.total_for(OuterRef('pk'))), 0))
+        Product.refresh_total_stock(sizes.values('product'))
+        bump_catalog_version()
+
+
+class StockMovement(models.Model):
+    """
+    Append-only history of stock changes, written next to the in-place
+    update of ProductSize.count, not instead of it: the conditional UPDATE
+    on the size row is what stops two checkouts from selling the same
+    unit, so every sale still writes that row and adds one insert here.
+    Contention on a hot size is handled by StockShard instead.
+
+    A size's stock can be derived from its StockSnapshot plus the
+    movements recorded after it (see ProductSize.ledger_count), which
+    `manage.py reconcile_stock` compares against the count.
+    """
+    SALE = 'sale'
+    REFUND = 'refund'
+    ADJUST = 'adjust'
+    REASONS = [(SALE, 'Sale'), (REFUND, 'Refund'), (ADJUST, 'Adjustment')]
+
+    size = models.ForeignKey(ProductSize, on_delete=models.CASCADE, related_name='movements')
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=16, choices=REASONS)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.delta:+d} {self.size} ({self.reason})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['size', 'id'], name='stockmovement_size_id_idx'),
+        ]
+
+
+class StockSnapshot(models.Model):
+    """
+    A size's stock folded from its movements up to `position`, the id of
+    the last movement included. Kept current by `manage.py compact_stock_ledger`.
+    """
+    size = models.OneToOneField(ProductSize, on_delete=models.CASCADE, related_name='snapshot')
+    count = models.IntegerField()
+    position = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.size}: {self.count} at #{self.position}"
+
+    @staticmethod
+    def compact():
+        """
+        Fold the movements recorded since each size's snapshot into it with
+        one upsert. Returns the number of snapshots written.
+        """
+        with transaction.atomic():
+            cutoff = StockMovement.objects.aggregate(last=Max('pk'))['last']
+            if cutoff is None:
+                return 0
+            deltas = dict(
+                StockMovement.objects.alias(folded=Coalesce(F('size__snapshot__position'), 0))
+                .filter(pk__lte=cutoff, pk__gt=F('folded')).order_by().values('size').annotate(total=Sum('delta')).values_list('size', 'total')
+            )
+            counts = dict(StockSnapshot.objects.filter(size__in=deltas).values_list('size', 'count'))
+            StockSnapshot.objects.bulk_create(
+                [StockSnapshot(size_id=size, count=counts.get(size, 0) + delta, position=cutoff)
+                 for size, delta in deltas.items()],
+                update_conflicts=True, unique_fields=['size'], update_fields=['count', 'position', 'taken_at'],
+            )
+            return len(deltas)
+
+    @staticmethod
+    def prune(before):
+        """Delete movements already folded into a snapshot and created before `before`."""
+        return StockMovement.objects.filter(pk__lte=F('size__snapshot__position'), created_at__lt=before).delete()[0]
+
+
+class PaymeEvent(models.Model):
+    """
+    Ledger of processed Payme webhook deliveries, one row per transaction
+    and method. Payme retries PerformTransaction and CancelTransaction until
+    it gets an answer; a retry is answered with the stored result after one
+    lookup on the unique index, without running the handler again.
+    """
+    PERFORM = 'PerformTransaction'
+    CANCEL = 'CancelTransaction'
+
+    transaction_id = models.CharField(max_length=50)
+    method = models.CharField(max_length=32, choices=[(PERFORM, PERFORM), (CANCEL, CANCEL)])
+    result = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.method} {self.transaction_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['transaction_id', 'method'], name='paymeevent_delivery_unique'),
+        ]
+
+    @staticmethod
+    def process_once(method, transaction_id, handler):
+        """
+        Return the stored result of `method` for `transaction_id`, or run
+        `handler()` and store its result in the same database transaction.
+        The row is inserted before the handler runs, so a concurrent
+        duplicate fails on the unique constraint and gets the winner's result.
+        """
+        stored = PaymeEvent.objects.filter(transaction_id=transaction_id, method=method) \
+            .values_list('result', flat=True).first()
+        if stored is not None:
+            return stored
+
+        try:
+            with transaction.atomic():
+                event = PaymeEvent.objects.create(transaction_id=transaction_id, method=method)
+                event.result = handler()
+                event.save(update_fields=['result'])
+        except IntegrityError:
+            return PaymeEvent.objects.get(transaction_id=transaction_id, method=method).result
+        return event.result
+
+
+class Job(models.Model):
+    """
+    Durable background job, run by `manage.py run_jobs` (see app.jobs).
+
+    Workers claim due jobs with a conditional UPDATE and a lease; a job
+    whose worker died is claimed again once the lease runs out, so every
+    job runs at least once and handlers must be idempotent. Failures are
+    retried with exponential backoff up to `max_attempts`.
+    """
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+    kind = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, default=PENDING, choices=[
+        (PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'),
+    ])
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=8)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=32, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+    @staticmethod
+    def enqueue(kind, **payload):
+        return Job.objects.create(kind=kind, payload=payload)
+
+    @staticmethod
+    def claim(limit=10, lease=300):
+        """
+        Lock up to `limit` due jobs for `lease` seconds and return them.
+        """
+        now = timezone.now()
+        due = Q(status=Job.PENDING, run_at__lte=now) | Q(status=Job.RUNNING, locked_until__lt=now)
+        ids = list(Job.objects.filter(due).order_by('run_at', 'id').values_list('pk', flat=True)[:limit])
+        if not ids:
+            return []
+
+        token = uuid.uuid4().hex
+        Job.objects.filter(due, pk__in=ids).update(
+            status=Job.RUNNING, locked_by=token, locked_until=now + timedelta(seconds=lease),
+            attempts=F('attempts') + 1, updated_at=now,
+        )
+        return list(Job.objects.filter(locked_by=token, status=Job.RUNNING).order_by('run_at', 'id'))
+
+    def finish(self):
+        # Only the current lease holder may complete the job
+        Job.objects.filter(pk=self.pk, locked_by=self.locked_by, status=Job.RUNNING) \
+            .update(status=Job.DONE, locked_until=None, updated_at=timezone.now())
+
+    def fail(self, error):
+        """Schedule a retry with exponential backoff, or give up after max_attempts."""
+        now = timezone.now()
+        retry = self.attempts < self.max_attempts
+        Job.objects.filter(pk=self.pk, locked_by=self.locked_by, status=Job.RUNNING).update(
+            status=Job.PENDING if retry else Job.FAILED,
+            run_at=now + timedelta(seconds=min(2 ** self.attempts, 3600)) if retry else self.run_at,
+            locked_until=None, last_error=error, updated_at=now,
+        )
+
+
+class NotificationQuerySet(models.QuerySet):
+    def with_viewed(self, user):
+        """
+        Annotate `has_viewed` for `user` with an EXISTS on the viewed_by_user
+        table's (notification, user) unique index, whatever the number of viewers.
+        """
+        viewed = Notification.viewed_by_user.through.objects.filter(notification=OuterRef('pk'), user=user.pk)
+        return self.annotate(has_viewed=Exists(viewed))
 
 
 class Notification(models.Model):
@@ -145,5 +828,61 @@ class Notification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     viewed_by_user = models.ManyToManyField(User, related_name='viewed_notifications', blank=True)
 
+    objects = NotificationQuerySet.as_manager()
+
     def __str__(self):
         return self.title
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='notification_created_idx'),
+        ]
+
+
+class UnreadNotifications(models.Model):
+    """
+    Number of notifications a user hasn't read, for the WebApp badge.
+
+    Created on the first count request, then kept current by the signals in
+    app.signals: every new notification adds one to every counter in one
+    UPDATE, reading (viewed_by_user.add) takes one off the reader's.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='unread_notifications')
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user}: {self.count}"
+
+    @staticmethod
+    def unread_query(user):
+        return Notification.objects.exclude(viewed_by_user=user)
+
+    @staticmethod
+    def count_for(user):
+        """The user's unread count, one primary key lookup once the counter exists."""
+        count = UnreadNotifications.objects.filter(user=user).values_list('count', flat=True).first()
+        if count is None:
+            count = UnreadNotifications.recount(user)
+        return count
+
+    @staticmethod
+    def recount(user):
+        """Recompute the user's counter from the notifications table."""
+        count = UnreadNotifications.unread_query(user).count()
+        UnreadNotifications.objects.update_or_create(user=user, defaults={'count': count})
+        return count
+
+    @staticmethod
+    def mark_all_read(user):
+        """
+        Mark every notification read by `user` with one bulk insert into the
+        viewed_by_user table. Returns the number of notifications marked.
+        """
+        Viewed = Notification.viewed_by_user.through
+        with transaction.atomic():
+            ids = list(UnreadNotifications.unread_query(user).values_list('id', flat=True))
+            # No m2m_changed signals here, the counter is reset below
+            Viewed.objects.bulk_create([Viewed(notification_id=pk, user_id=user.pk) for pk in ids],
+                                       ignore_conflicts=True)
+            UnreadNotifications.objects.update_or_create(user=user, defaults={'count': 0})
+        return len(ids)
@@ -0,0 +1,67 @@
+"""
+Wake-ups for clients long-polling an order's payment status.
+
+Orders are usually paid by the run_jobs worker, another process, so the
+waiters of an ASGI process are woken by one watcher task per event loop
+that checks every waiting order in a single query each
+PAYMENT_STATUS_POLL seconds, however many clients are waiting. When the
+payment is made in this process, OrderItem.deduct_stock calls
+notify_paid() after commit and its waiters wake at once.
+"""
+import asyncio
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+_waiters = defaultdict(set)  # order id -> {(loop, event)}
+_watchers = {}  # loop -> watcher task
+
+
+def notify_paid(order_id):
+    """Wake everyone waiting on `order_id`; safe to call from any thread."""
+    for loop, event in list(_waiters.get(order_id, ())):
+        loop.call_soon_threadsafe(event.set)
+
+
+def _settled(order_ids):
+    """The ids among `order_ids` that are paid or gone, in one query."""
+    from .models import Order
+    paid = dict(Order.objects.filter(pk__in=order_ids).values_list('pk', 'is_paid'))
+    return [pk for pk in order_ids if paid.get(pk, True)]  # Missing orders end the wait too
+
+
+def _waiting(loop):
+    return [pk for pk, waiters in list(_waiters.items()) if any(waiter[0] is loop for waiter in waiters)]
+
+
+async def _watch(loop):
+    """Runs while `loop` has waiters, the last one to leave cancels it."""
+    while True:
+        await asyncio.sleep(getattr(settings, 'PAYMENT_STATUS_POLL', 0.5))
+        for order_id in await sync_to_async(_settled)(_waiting(loop)):
+            notify_paid(order_id)
+
+
+async def wait_until_paid(order_id, timeout):
+    """
+    Return as soon as the order is paid or missing, or after `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    waiter = (loop, asyncio.Event())
+    _waiters[order_id].add(waiter)
+    try:
+        if await sync_to_async(_settled)([order_id]):
+            return
+        if loop not in _watchers:
+            _watchers[loop] = loop.create_task(_watch(loop))
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        _waiters[order_id].discard(waiter)
+        if not _waiters[order_id]:
+            del _waiters[order_id]
+        if not _waiting(loop) and loop in _watchers:
+            _watchers.pop(loop).cancel()
@@ -0,0 +1,232 @@
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .models import SHUFFLE_KEY_SPACE, SHUFFLE_KEYS
+
+
+def shuffle_offset(seed):
+    """
+    Map a feed seed to one of the SHUFFLE_KEYS fields, a starting key on it and a walking direction.
+    """
+    digest = int.from_bytes(hashlib.blake2b(seed.encode(), digest_size=8).digest(), 'big')
+    digest, offset = divmod(digest, SHUFFLE_KEY_SPACE)
+    digest, descending = divmod(digest, 2)
+    return SHUFFLE_KEYS[digest % len(SHUFFLE_KEYS)], offset, bool(descending)
+
+
+def _cursor_default(value):
+    # Full precision, DjangoJSONEncoder would cut microseconds
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a unique ordering such as ('price', 'id').
+
+    The cursor holds the ordering values of the last row of the page and the
+    next page is fetched with `WHERE (price, id) > (last_price, last_id)`, so
+    page N is the same index range scan as page 1. Views set
+    `keyset_ordering` or implement `get_keyset_ordering()`; the last field
+    must be unique.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    ordering = ('id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.next_cursor = None
+
+        ordering = self.get_ordering(view)
+        position = self.decode_cursor(request)
+        if position is not None:
+            if len(position) != len(ordering):
+                raise NotFound(self.invalid_cursor_message)
+            queryset = queryset.filter(self.after_filter(ordering, position))
+
+        rows = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        if len(rows) > self.page_size:
+            self.next_cursor = self.position_of(rows[self.page_size - 1], ordering)
+        return rows[:self.page_size]
+
+    def get_ordering(self, view):
+        if hasattr(view, 'get_keyset_ordering'):
+            return view.get_keyset_ordering()
+        return getattr(view, 'keyset_ordering', self.ordering)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    @staticmethod
+    def position_of(obj, ordering):
+        if isinstance(obj, dict):  # .values() rows
+            return [obj[field.lstrip('-')] for field in ordering]
+        return [getattr(obj, field.lstrip('-')) for field in ordering]
+
+    @staticmethod
+    def after_filter(ordering, values):
+        """
+        Rows strictly after `values` in `ordering`, as
+        `f0 >= v0 AND (f0 > v0 OR (f0 = v0 AND f1 > v1) OR ...)`.
+        The leading bound lets the database start an index range scan.
+        """
+        condition, equal = Q(), Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+
+        first = ordering[0]
+        bound = 'lte' if first.startswith('-') else 'gte'
+        return Q(**{f'{first.lstrip("-")}__{bound}': values[0]}) & condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            position = json.loads(urlsafe_b64decode(encoded.encode()))
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(position, list) or not position:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    @staticmethod
+    def encode_cursor(position):
+        raw = json.dumps(position, default=_cursor_default, separators=(',', ':'))
+        return urlsafe_b64encode(raw.encode()).decode()
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_cursor))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ShuffledFeedPagination(KeysetPagination):
+    """
+    Stable pseudo-random product feed.
+
+    Every product carries several random, indexed shuffle keys (see
+    SHUFFLE_KEYS), each an independent order of the catalog. The seed picks
+    one of them, a starting key and a direction; the feed walks the
+    (key, id) index from there to the end of the key space (phase 0) and
+    then wraps around to the beginning (phase 1). The cursor is
+    `[phase, key, id]`, so pages for a seed never repeat or skip.
+    """
+    seed_query_param = 'seed'
+    seed_pool = 64
+
+    def get_seed(self, request):
+        """
+        The requested seed, or one of `seed_pool` server seeds picked by the
+        user, so that first pages stay cacheable and a user's repeat visit
+        revalidates against the same ETag.
+        """
+        if not hasattr(self, 'seed'):
+            self.seed = request.query_params.get(self.seed_query_param) or self.default_seed(request.user)
+        return self.seed
+
+    def default_seed(self, user):
+        digest = hashlib.blake2b(user.get_username().encode(), digest_size=8).digest()
+        return str(int.from_bytes(digest, 'big') % self.seed_pool)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.seed = self.get_seed(request)
+        self.key, self.offset, self.descending = shuffle_offset(self.seed)
+        self.next_cursor = None
+
+        phase, position = self.decode_phase(request)
+        ordering = (f'-{self.key}', '-id') if self.descending else (self.key, 'id')
+        page = []
+
+        for current in range(phase, 2):
+            rows = queryset.filter(self.phase_filter(current))
+            if current == phase and position is not None:
+                rows = rows.filter(self.after_filter(ordering, position))
+
+            wanted = self.page_size - len(page)
+            rows = list(rows.order_by(*ordering)[:wanted + 1])
+            page.extend(rows[:wanted])
+
+            if len(rows) > wanted:
+                # More rows are left in this phase
+                last = rows[wanted - 1] if wanted else None
+                self.next_cursor = [current] + (self.position_of(last, ordering) if last else [])
+                break
+
+        return page
+
+    def phase_filter(self, phase):
+        # Ascending feeds start at the offset, descending ones just below it
+        if (phase == 0) != self.descending:
+            return Q(**{f'{self.key}__gte': self.offset})
+        return Q(**{f'{self.key}__lt': self.offset})
+
+    def decode_phase(self, request):
+        position = self.decode_cursor(request)
+        if position is None:
+            return 0, None
+        if position[0] not in (0, 1) or len(position) not in (1, 3):
+            raise NotFound(self.invalid_cursor_message)
+        return position[0], position[1:] or None
+
+    def get_next_link(self):
+        url = super().get_next_link()
+        if url is None:
+            return None
+        return replace_query_param(url, self.seed_query_param, self.seed)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'seed': self.seed,
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema['required'] = ['seed', 'results']
+        response_schema['properties']['seed'] = {'type': 'string'}
+        return response_schema
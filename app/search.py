@@ -0,0 +1,148 @@
+"""
+Full-text product search.
+
+On SQLite products are indexed in the `app_product_fts` FTS5 table (rowid =
+product id), kept in sync by the Product save/delete signals and rebuilt by
+`manage.py rebuild_search_index`. Other backends fall back to icontains.
+"""
+import re
+
+from django.db import connection, OperationalError
+from django.db.models import Q, Case, When, Value, IntegerField
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+from .models import Product
+
+FTS_TABLE = 'app_product_fts'
+
+# Uzbek Latin is written with several apostrophe variants (oʻ, g‘, o'),
+# and they are often left out altogether, so they are dropped on both sides.
+APOSTROPHES = re.compile(r"['`´ʻʼ‘’]")
+TOKENS = re.compile(r'\w+')
+
+_fts_enabled = None
+
+
+def normalize(text):
+    return APOSTROPHES.sub('', text or '').lower()
+
+
+def tokenize(term):
+    return TOKENS.findall(normalize(term))
+
+
+def create_index(cursor):
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "name, description, "
+        "tokenize=\"unicode61 remove_diacritics 2\", prefix='2 3')"
+    )
+
+
+def fts_enabled():
+    """Whether the FTS5 table exists on the default database."""
+    global _fts_enabled
+    if _fts_enabled is None:
+        _fts_enabled = connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+    return _fts_enabled
+
+
+def index_product(product):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product.pk])
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)",
+            [product.pk, normalize(product.name), normalize(product.description)]
+        )
+
+
+def remove_product(product_id):
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product_id])
+
+
+def rebuild_index(batch_size=1000):
+    """
+    Recreate the FTS5 table from the Product table. Returns the number of indexed products.
+    """
+    global _fts_enabled
+    if connection.vendor != 'sqlite':
+        return 0
+
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+            create_index(cursor)
+        except OperationalError:  # SQLite built without FTS5
+            _fts_enabled = False
+            return 0
+        _fts_enabled = True
+
+        total, batch = 0, []
+        rows = Product.objects.values_list('id', 'name', 'description').iterator(chunk_size=batch_size)
+        for pk, name, description in rows:
+            batch.append((pk, normalize(name), normalize(description)))
+            if len(batch) >= batch_size:
+                cursor.executemany(f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)", batch)
+                total, batch = total + len(batch), []
+        if batch:
+            cursor.executemany(f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)", batch)
+            total += len(batch)
+    return total
+
+
+def search_products(queryset, term):
+    """
+    Filter products matching every word of `term` (as a prefix) and annotate
+    `search_rank`, lower is more relevant.
+    """
+    tokens = tokenize(term)
+    if not tokens:
+        return queryset
+
+    if fts_enabled():
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        table = Product._meta.db_table
+        # The index is joined once so MATCH runs once per query and bm25() reads the joined row,
+        # matches in the name weigh ten times more than in the description
+        return queryset.extra(
+            tables=[FTS_TABLE], where=[f"{FTS_TABLE}.rowid = {table}.id", f"{FTS_TABLE} MATCH %s"], params=[match]
+        ).annotate(search_rank=RawSQL(f"bm25({FTS_TABLE}, 10.0, 1.0)", []))
+
+    condition = Q()
+    for token in tokens:
+        condition &= Q(name__icontains=token) | Q(description__icontains=token)
+    return queryset.filter(condition).annotate(search_rank=Case(
+        When(name__istartswith=tokens[0], then=Value(0)),
+        When(name__icontains=tokens[0], then=Value(1)),
+        default=Value(2),
+        output_field=IntegerField(),
+    ))
+
+
+class ProductSearchFilter(filters.BaseFilterBackend):
+    """
+    Replacement for SearchFilter on products, backed by the full-text index.
+    """
+    search_param = api_settings.SEARCH_PARAM
+
+    def get_search_term(self, request):
+        return request.query_params.get(self.search_param, '')
+
+    def filter_queryset(self, request, queryset, view):
+        return search_products(queryset, self.get_search_term(request))
+
+    def get_schema_operation_parameters(self, view):
+        return [{
+            'name': self.search_param,
+            'required': False,
+            'in': 'query',
+            'description': 'Full-text search over product name and description (prefix matching).',
+            'schema': {'type': 'string'},
+        }]
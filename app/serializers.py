@@ -1,6 +1,9 @@
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Product, Category, LikeDislike, OrderItem, Order, Notification, Size, ProductSize
+from . import liked_cache
+from .models import Product, Category, LikeDislike, OrderItem, Order, Notification, Size, ProductSize, StockHold
 
 
 class ProductSizeSerializer(serializers.ModelSerializer):
@@ -15,7 +18,43 @@ class ProductSizeSerializer(serializers.ModelSerializer):
         return obj.count > 0  # True if count is greater than 0
 
 
-class ProductSerializer(serializers.ModelSerializer):
+def query_list(request, param):
+    """Comma separated query parameter as a set, e.g. ?fields=id,name,price"""
+    if request is None:
+        return set()
+    return {name.strip() for name in request.query_params.get(param, '').split(',') if name.strip()}
+
+
+class DynamicFieldsMixin:
+    """
+    Sparse fieldsets: `?fields=name,price` keeps only the listed fields (`id`
+    is always kept) and `?expand=category` swaps a field for its
+    `expandable_fields` serializer. Applied in get_fields(), so it also works
+    for nested serializers.
+    """
+    expandable_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+
+        for name in query_list(request, 'expand') & set(self.expandable_fields):
+            serializer_class, options = self.expandable_fields[name]
+            fields[name] = serializer_class(**options)
+
+        only = query_list(request, 'fields')
+        if only:
+            fields = {name: field for name, field in fields.items() if name in only or name == 'id'}
+        return fields
+
+
+class SimpleCategorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Category
+        fields = ['id', 'name']
+
+
+class ProductSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     liked_by_user = serializers.SerializerMethodField()
     total_count = serializers.SerializerMethodField()
     sizes = ProductSizeSerializer(source='productsize_set', many=True)
@@ -25,19 +64,30 @@ class ProductSerializer(serializers.ModelSerializer):
         fields = ['id', 'category', 'name', 'price', 'sizes', 'description', 'image', 'total_count', 'liked_by_user']
         read_only_fields = ['liked_by_user']
 
+    expandable_fields = {
+        'category': (SimpleCategorySerializer, {'read_only': True}),
+    }
+
     def get_liked_by_user(self, obj):
+        # Annotated by Product.objects.for_listing()
+        if hasattr(obj, 'is_liked'):
+            return obj.is_liked
+
         request = self.context.get('request')
 
         # Check if request exists and if the user is authenticated
         if request and hasattr(request, 'user') and request.user.is_authenticated:
-            user_id = request.user.username
-            return LikeDislike.objects.filter(product=obj, user=user_id, is_like=True).exists()
+            # Checked once per serialization, list items share the context
+            if 'liked_ids' not in self.context:
+                username = request.user.username
+                self.context['liked_ids'] = liked_cache.liked_ids(username, liked_cache.last_toggle(username))
+            return obj.pk in self.context['liked_ids']
 
         # If no authenticated user, return False (not liked by any user)
         return False
 
     def get_total_count(self, obj):
-        return obj.total_count()
+        return obj.total_stock
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -48,6 +98,15 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'products']
 
 
+class CategoryListSerializer(serializers.ModelSerializer):
+    """Category menu entry, products are fetched per category."""
+    product_count = serializers.IntegerField(read_only=True)  # Annotated
+
+    class Meta:
+        model = Category
+        fields = ['id', 'name', 'product_count']
+
+
 class LikeDislikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = LikeDislike
@@ -70,9 +129,11 @@ class AddOrderItemSerializer(serializers.ModelSerializer):
         except ProductSize.DoesNotExist:
             raise serializers.ValidationError("Invalid size or product.")
 
-        # **Fetch the latest stock value**
-        if data['quantity'] > size.count:
-            raise serializers.ValidationError(f"Only {size.count} items are available for this size.")
+        # Other carts' holds count against the stock
+        active = Order.objects.filter(user=self.context['request'].user, is_paid=False).first()
+        available = size.available_count(exclude_order=active)
+        if data['quantity'] > available:
+            raise serializers.ValidationError(f"Only {available} items are available for this size.")
         return data
 
     def create(self, validated_data):
@@ -91,16 +152,18 @@ class AddOrderItemSerializer(serializers.ModelSerializer):
             # Update the quantity if the item already exists in the order
             existing_item.quantity += validated_data['quantity']
 
-            # Validate stock again before saving
-            if existing_item.quantity > size.count:
-                raise serializers.ValidationError(f"Only {size.count} items are available for this size.")
+            # Validate stock again before saving, other carts' holds included
+            available = size.available_count(exclude_order=order)
+            if existing_item.quantity > available:
+                raise serializers.ValidationError(f"Only {available} items are available for this size.")
 
             existing_item.save()
             return existing_item
         else:
             # Create a new OrderItem
-            if validated_data['quantity'] > size.count:
-                raise serializers.ValidationError(f"Only {size.count} items are available for this size.")
+            available = size.available_count(exclude_order=order)
+            if validated_data['quantity'] > available:
+                raise serializers.ValidationError(f"Only {available} items are available for this size.")
 
             return OrderItem.objects.create(
                 order=order,
@@ -155,9 +218,10 @@ class UpdateOrderItemSerializer(serializers.Serializer):
         order_item = OrderItem.objects.get(id=order_item_id)
         size = order_item.size
 
-        # Validate stock availability
-        if new_quantity > size.count + order_item.quantity:
-            raise serializers.ValidationError(f"Only {size.count + order_item.quantity} items are available for this size.")
+        # Validate stock availability; the item's own hold is part of what it may keep
+        available = size.available_count(exclude_order=order_item.order_id)
+        if new_quantity > available:
+            raise serializers.ValidationError(f"Only {available} items are available for this size.")
 
         # Update the OrderItem quantity
         order_item.quantity = new_quantity
@@ -166,6 +230,97 @@ class UpdateOrderItemSerializer(serializers.Serializer):
         return order_item
 
 
+class CartOperationSerializer(serializers.Serializer):
+    ADD, UPDATE, REMOVE = 'add', 'update', 'remove'
+
+    op = serializers.ChoiceField(choices=[ADD, UPDATE, REMOVE])
+    size_id = serializers.IntegerField(required=False)  # ProductSize ID, for add
+    product_id = serializers.IntegerField(required=False)  # Optional check for add
+    order_item_id = serializers.IntegerField(required=False)  # For update and remove
+    quantity = serializers.IntegerField(required=False, min_value=1)
+
+    def validate(self, data):
+        required = {self.ADD: ['size_id'], self.UPDATE: ['order_item_id', 'quantity'],
+                    self.REMOVE: ['order_item_id']}[data['op']]
+        missing = {name: "This field is required." for name in required if name not in data}
+        if missing:
+            raise serializers.ValidationError(missing)
+        return data
+
+
+class BatchOrderItemsSerializer(serializers.Serializer):
+    """
+    Applies a list of add / update / remove operations to the user's active
+    order in one transaction: the order's items and every referenced
+    ProductSize are read once, stock is checked once against the final
+    quantities, and the changes are written with one bulk_create, one
+    bulk_update and one delete.
+    """
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=100)
+
+    def save(self):
+        user = self.context['request'].user
+        operations = self.validated_data['operations']
+
+        with transaction.atomic():
+            order, _ = Order.objects.get_or_create(user=user, is_paid=False)
+            items = {item.id: item for item in order.items.all()}
+            by_size = {item.size_id: item for item in items.values()}
+
+            size_ids = {item.size_id for item in items.values()}
+            size_ids.update(operation['size_id'] for operation in operations if 'size_id' in operation)
+            sizes = ProductSize.objects.select_for_update().select_related('size', 'product').in_bulk(size_ids)
+
+            errors, added, changed, removed = {}, [], set(), set()
+            for index, operation in enumerate(operations):
+                if operation['op'] == CartOperationSerializer.ADD:
+                    size = sizes.get(operation['size_id'])
+                    if size is None or operation.get('product_id', size.product_id) != size.product_id:
+                        errors[index] = "Invalid size or product."
+                    elif operation['size_id'] in by_size:
+                        item = by_size[operation['size_id']]
+                        item.quantity += operation.get('quantity', 1)
+                        if item.pk:  # A size added earlier in this batch is already in `added`
+                            changed.add(item.pk)
+                    else:
+                        item = OrderItem(order=order, product_id=size.product_id, size=size,
+                                         quantity=operation.get('quantity', 1))
+                        by_size[size.id] = item
+                        added.append(item)
+                    continue
+
+                item = items.get(operation['order_item_id'])
+                if item is None or item.id in removed:
+                    errors[index] = "OrderItem not found or not part of your active order."
+                elif operation['op'] == CartOperationSerializer.UPDATE:
+                    item.quantity = operation['quantity']
+                    changed.add(item.id)
+                else:
+                    removed.add(item.id)
+                    del by_size[item.size_id]
+
+            if errors:
+                raise serializers.ValidationError({'operations': errors})
+
+            held = StockHold.objects.held_by_size(list(by_size), exclude_order=order)
+            for size_id, item in by_size.items():
+                size = sizes[size_id]
+                available = size.count - held.get(size_id, 0)
+                if item.quantity > available:
+                    errors[size_id] = f"Only {available} items are available for {size.size.name} of {size.product.name}."
+            if errors:
+                raise serializers.ValidationError({'stock': errors})
+
+            # The bulk writes skip OrderItem.save() and its signals
+            OrderItem.objects.filter(id__in=removed).delete()
+            OrderItem.objects.bulk_create(added)
+            OrderItem.objects.bulk_update([items[pk] for pk in changed - removed], ['quantity'])
+            StockHold.place_many(added + [items[pk] for pk in changed - removed])
+            Order.objects.filter(pk=order.pk).update(updated_at=timezone.now())
+
+        return order
+
+
 class SimpleProductSerializer(serializers.ModelSerializer):
     image = serializers.SerializerMethodField()
 
@@ -229,12 +384,16 @@ class NotificationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Notification
-        fields = ['id', 'title', 'message', 'created_at', 'viewed_by_user', 'has_viewed']
+        fields = ['id', 'title', 'message', 'created_at', 'has_viewed']
 
     # This method will return True if the current user has viewed the notification, else False
     def get_has_viewed(self, obj):
+        # Annotated by Notification.objects.with_viewed()
+        if hasattr(obj, 'has_viewed'):
+            return obj.has_viewed
+
         user = self.context.get('request').user
-        return user in obj.viewed_by_user.all()
+        return obj.viewed_by_user.filter(pk=user.pk).exists()
 
 
 class OrderStatusSerializer(serializers.ModelSerializer):
@@ -0,0 +1,81 @@
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import search
+from .caching import bump_catalog_version
+from .models import Category, Product, ProductSize, Order, OrderItem, Notification, UnreadNotifications
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove_product(instance.pk)
+
+
+@receiver(post_save, sender=ProductSize)
+@receiver(post_delete, sender=ProductSize)
+def refresh_total_stock(sender, instance, **kwargs):
+    Product.refresh_total_stock([instance.product_id])
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductSize)
+@receiver(post_delete, sender=ProductSize)
+def invalidate_catalog(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def touch_order(sender, instance, **kwargs):
+    # Order.updated_at backs the active order ETag
+    Order.objects.filter(pk=instance.order_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Notification)
+def count_new_notification(sender, instance, created, **kwargs):
+    if created:
+        UnreadNotifications.objects.update(count=F('count') + 1)
+
+
+@receiver(pre_delete, sender=Notification)
+def uncount_deleted_notification(sender, instance, **kwargs):
+    UnreadNotifications.objects.exclude(user__viewed_notifications=instance).filter(count__gt=0) \
+        .update(count=F('count') - 1)
+
+
+@receiver(m2m_changed, sender=Notification.viewed_by_user.through)
+def count_reads(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add':
+        # Django leaves rows that already existed out of pk_set
+        change = -len(pk_set)
+    elif action in ('pre_remove', 'pre_clear'):
+        # pk_set is whatever the caller asked to remove (None for clear), count the rows that will go
+        rows = sender.objects.filter(**{'user' if reverse else 'notification': instance})
+        if pk_set is not None:
+            rows = rows.filter(**{'notification__in' if reverse else 'user__in': pk_set})
+        if reverse:
+            change = rows.count()
+        else:
+            pk_set = set(rows.values_list('user', flat=True))
+            change = len(pk_set)
+    else:
+        return
+    if not change:
+        return
+
+    if reverse:  # user.viewed_notifications.add(...)
+        counters = UnreadNotifications.objects.filter(user=instance)
+    else:  # notification.viewed_by_user.add(...), one notification per user
+        counters, change = UnreadNotifications.objects.filter(user__in=pk_set), 1 if change > 0 else -1
+    counters.update(count=Greatest(F('count') + change, 0))
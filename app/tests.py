@@ -1,3 +1,1373 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.db import connection, OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from . import liked_cache, order_events, pagination, search, views
+from .serializers import ProductSerializer, CategorySerializer, OrderSerializer, AddOrderItemSerializer
+from .models import Category, Size, Product, ProductSize, LikeDislike, Notification, Order, OrderItem, StockHold, \
+    PaymeEvent, Job, StockMovement, StockSnapshot, StockShard, UnreadNotifications
+
+
+def create_catalog(products=500, sizes=('S', 'M', 'L')):
+    """Bulk-create a catalog of products, each stocked in every size."""
+    category = Category.objects.create(name='Kiyimlar')
+    size_objects = [Size.objects.create(name=name) for name in sizes]
+    Product.objects.bulk_create([
+        Product(category=category, name=f"Mahsulot {i}", price=1000 + i, description=f"Tavsif {i}")
+        for i in range(products)
+    ])
+    ProductSize.objects.bulk_create([
+        ProductSize(product=product, size=size, count=i % 7)
+        for product in Product.objects.all()
+        for i, size in enumerate(size_objects)
+    ])
+    Product.refresh_total_stock(Product.objects.values('id'))
+    return category
+
+
+class APITestCase(TestCase):
+    """Authenticated API client over an empty catalog cache."""
+
+    def setUp(self):
+        cache.clear()
+        liked_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class ProductListQueryTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.category = create_catalog(products=500)
+        liked = Product.objects.order_by('id')[:10]
+        LikeDislike.objects.bulk_create([
+            LikeDislike(product=product, user=cls.user.username, is_like=True) for product in liked
+        ])
+
+    def test_product_list_query_count_is_constant(self):
+        # catalog version + products + prefetched sizes (joined with Size) + like overlay
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('product-list'), {'price_filter': 'aasc'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(sum(item['liked_by_user'] for item in response.data['results']), 10)
+
+    def test_product_detail_query_count_is_constant(self):
+        product = Product.objects.order_by('id').first()
+
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('product-detail', args=[product.id]))
+
+        self.assertEqual(response.data['total_count'], product.total_count())
+        self.assertTrue(response.data['liked_by_user'])
+        self.assertEqual(len(response.data['sizes']), 3)
+
+
+class ShuffledFeedTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        create_catalog(products=45)
+
+    def fetch_feed(self, seed):
+        ids, url, params = [], reverse('product-list'), {'seed': seed}
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.data['seed'], seed)
+            ids.extend(item['id'] for item in response.data['results'])
+            url, params = response.data['next'], None
+        return ids
+
+    def test_pages_cover_catalog_without_repeats(self):
+        for seed in ('a', 'b', 'c', '42'):
+            ids = self.fetch_feed(seed)
+            self.assertEqual(len(ids), 45)
+            self.assertEqual(set(ids), set(Product.objects.values_list('id', flat=True)))
+
+    def test_order_is_stable_per_seed(self):
+        self.assertEqual(self.fetch_feed('a'), self.fetch_feed('a'))
+        self.assertNotEqual(self.fetch_feed('a'), self.fetch_feed('b'))
+
+    def test_seeds_walk_different_orders(self):
+        seeds = {}
+        for seed in map(str, range(100)):
+            seeds.setdefault(pagination.shuffle_offset(seed)[0], seed)
+        self.assertEqual(len(seeds), 4)
+
+        feeds = [self.fetch_feed(seed) for seed in seeds.values()]
+        for i, feed in enumerate(feeds):
+            for other in feeds[i + 1:]:
+                # Not the same order started elsewhere or walked backwards
+                turns = {tuple(other[k:] + other[:k]) for k in range(len(other))}
+                self.assertNotIn(tuple(feed), turns)
+                self.assertNotIn(tuple(reversed(feed)), turns)
+
+    def test_seed_is_generated_when_missing(self):
+        response = self.client.get(reverse('product-list'))
+
+        self.assertTrue(response.data['seed'])
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(self.client.get(reverse('product-list')).data['seed'], response.data['seed'])
+
+
+class LikeTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        create_catalog(products=5)
+        cls.products = list(Product.objects.order_by('id'))
+
+    def test_toggle_is_one_statement(self):
+        url = reverse('like_product', args=[self.products[0].pk])
+        states = []
+        for _ in range(3):
+            with self.assertNumQueries(4):  # savepoints, upsert, like_count
+                states.append(self.client.post(url).data['liked'])
+
+        self.assertEqual(states, [True, False, True])
+        self.assertEqual(LikeDislike.objects.get().is_like, True)
+        self.products[0].refresh_from_db()
+        self.assertEqual(self.products[0].like_count, 1)
+
+    def test_serializer_falls_back_to_the_liked_cache(self):
+        LikeDislike.toggle(self.user.username, self.products[1].pk)
+        request = Request(APIRequestFactory().get('/'))
+        request.user = self.user
+
+        data = ProductSerializer(self.products[:2], many=True, context={'request': request}).data
+        self.assertEqual([item['liked_by_user'] for item in data], [False, True])
+
+        LikeDislike.toggle(self.user.username, self.products[0].pk)  # Through another process
+        data = ProductSerializer(self.products[:2], many=True, context={'request': request}).data
+        self.assertEqual([item['liked_by_user'] for item in data], [True, True])
+
+    def test_toggle_of_missing_product(self):
+        response = self.client.post(reverse('like_product', args=[0]))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(LikeDislike.objects.exists())
+
+    def test_toggle_changes_the_catalog_etag(self):
+        response = self.client.get(reverse('product-list'))
+        self.client.post(reverse('like_product', args=[self.products[0].pk]))
+
+        response = self.client.get(reverse('product-list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def popular_ids(self):
+        ids, url, params = [], reverse('product-list'), {'price_filter': 'popular', 'page_size': 2}
+        while url:
+            response = self.client.get(url, params)
+            ids.extend(item['id'] for item in response.data['results'])
+            url, params = response.data['next'], None
+        return ids
+
+    def test_popular_ordering_reads_the_snapshot(self):
+        first, second, third = self.products[:3]
+        for user, product in [('1', third), ('2', third), ('3', second)]:
+            LikeDislike.toggle(user, product.pk)
+        rest = sorted((product.pk for product in self.products[3:]), reverse=True)
+
+        self.assertEqual(self.popular_ids(), sorted((product.pk for product in self.products), reverse=True))
+        call_command('refresh_popularity', stdout=StringIO())
+        self.assertEqual(self.popular_ids(), [third.pk, second.pk] + rest + [first.pk])
+
+        LikeDislike.toggle('1', third.pk)
+        LikeDislike.toggle('2', third.pk)
+        self.assertEqual(self.popular_ids()[0], third.pk)  # Until the next refresh
+        self.assertEqual(Product.refresh_popularity(), 1)
+        self.assertEqual(self.popular_ids()[0], second.pk)
+
+    def test_recount_repairs_bulk_written_likes(self):
+        LikeDislike.objects.bulk_create([
+            LikeDislike(product=self.products[4], user=str(i), is_like=i % 2 == 0) for i in range(5)
+        ])
+
+        call_command('refresh_popularity', '--recount', stdout=StringIO())
+        self.products[4].refresh_from_db()
+        self.assertEqual((self.products[4].like_count, self.products[4].popularity), (3, 3))
+
+    @override_settings(LIKED_CACHE_SIZE=2)
+    def test_liked_cache_is_bounded_and_invalidated_by_toggles(self):
+        for user in ('1', '2', '3'):
+            liked_cache.liked_ids(user)
+        self.assertEqual(list(liked_cache._entries), ['2', '3'])
+
+        self.client.get(reverse('liked-products'))
+        self.client.post(reverse('like_product', args=[self.products[0].pk]))
+        with self.assertNumQueries(4):  # last toggle, liked ids, products, sizes
+            response = self.client.get(reverse('liked-products'))
+        self.assertEqual([(item['id'], item['liked_by_user']) for item in response.data['results']],
+                         [(self.products[0].pk, True)])
+
+        LikeDislike.toggle(self.user.username, self.products[1].pk)  # Through another process
+        response = self.client.get(reverse('liked-products'))
+        self.assertEqual([item['id'] for item in response.data['results']], [self.products[0].pk, self.products[1].pk])
+
+    def test_bulk_status(self):
+        LikeDislike.objects.create(product=self.products[1], user=self.user.username, is_like=True)
+        LikeDislike.objects.create(product=self.products[2], user=self.user.username, is_like=False)
+        LikeDislike.objects.create(product=self.products[3], user='654321', is_like=True)
+        ids = ','.join(str(product.pk) for product in self.products[:4])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('like_status'), {'ids': ids})
+
+        self.assertEqual(response.json()['liked'], {
+            str(self.products[0].pk): False, str(self.products[1].pk): True,
+            str(self.products[2].pk): False, str(self.products[3].pk): False,
+        })
+        self.assertEqual(self.client.get(reverse('like_status'), {'ids': '1,x'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('like_status'), {'ids': ','.join(map(str, range(101)))}).status_code,
+                         400)
+
+
+class KeysetPaginationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        category = create_catalog(products=50)
+        other = Category.objects.create(name='Poyabzal')
+        Product.objects.filter(id__in=Product.objects.order_by('id').values('id')[:15]).update(category=other)
+        # Duplicate prices must not make pages repeat or skip rows
+        Product.objects.filter(id__in=Product.objects.order_by('-id').values('id')[:10]).update(price=1010)
+        cls.category = category
+
+    def walk(self, url, params):
+        ids = []
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data['results'])
+            url, params = response.data['next'], None
+        return ids
+
+    def test_price_pages_follow_price_order(self):
+        for price_filter, ordering in (('aasc', ('price', 'id')), ('desc', ('-price', '-id'))):
+            ids = self.walk(reverse('product-list'), {'price_filter': price_filter, 'page_size': 7})
+            expected = list(Product.objects.order_by(*ordering).values_list('id', flat=True))
+            self.assertEqual(ids, expected)
+
+    def test_pages_respect_category_filter(self):
+        ids = self.walk(reverse('product-list'), {'price_filter': 'aasc', 'category_name': self.category.name})
+        expected = Product.objects.filter(category=self.category).order_by('price', 'id')
+        self.assertEqual(ids, list(expected.values_list('id', flat=True)))
+
+    def test_later_pages_cost_the_same_as_the_first(self):
+        url = reverse('product-list')
+        with self.assertNumQueries(4):  # catalog version, products, sizes, liked ids
+            response = self.client.get(url, {'price_filter': 'desc', 'page_size': 10})
+        for _ in range(3):
+            with self.assertNumQueries(3):  # liked ids are cached now
+                response = self.client.get(response.data['next'])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('product-list'), {'price_filter': 'aasc', 'cursor': 'bogus'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_notifications_are_paginated_newest_first(self):
+        Notification.objects.bulk_create([Notification(title=f"Xabar {i}", message='...') for i in range(25)])
+
+        ids = self.walk(reverse('notifications'), {'page_size': 10})
+
+        expected = Notification.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        self.assertEqual(ids, list(expected))
+
+
+class ProductSearchTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        category = Category.objects.create(name='Kiyimlar')
+        cls.shirt = Product.objects.create(category=category, name="Ko‘ylak", price=100, description="Paxta")
+        cls.dress = Product.objects.create(category=category, name="Shim", price=200,
+                                           description="Ko'ylak bilan kiyiladigan shim")
+        cls.shoes = Product.objects.create(category=category, name="Tufli", price=300, description="Charm")
+
+    def search(self, term):
+        response = self.client.get(reverse('product-list'), {'search': term})
+        return [item['id'] for item in response.data['results']]
+
+    def test_prefix_match_ignores_apostrophe_variants(self):
+        self.assertEqual(self.search("ko'yl"), [self.shirt.id, self.dress.id])
+        self.assertEqual(self.search("koylak"), [self.shirt.id, self.dress.id])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.shoes.name = 'Krossovka'
+        self.shoes.save()
+        self.assertEqual(self.search('kross'), [self.shoes.id])
+        self.assertEqual(self.search('tufli'), [])
+
+        self.shoes.delete()
+        self.assertEqual(self.search('kross'), [])
+
+    def test_ranked_pages_run_the_match_once_per_query(self):
+        for i in range(12):
+            # More mentions of the word in the name rank higher
+            Product.objects.create(category=self.shirt.category, name='Sumka ' + 'sumka ' * (i % 4), price=i,
+                                   description='Teri')
+        ids, params = [], {'search': 'sumka', 'page_size': 5}
+        with CaptureQueriesContext(connection) as context:
+            url = reverse('product-list')
+            while url:
+                data = self.client.get(url, params).data
+                ids += [item['id'] for item in data['results']]
+                url, params = data['next'], None
+
+        expected = [p.id for p in sorted(search.search_products(Product.objects.all(), 'sumka'),
+                                         key=lambda p: (p.search_rank, p.id))]
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(ids), 12)
+        for query in context.captured_queries:
+            self.assertLessEqual(query['sql'].count('MATCH'), 1)
+
+    def test_rebuild_command_indexes_bulk_created_products(self):
+        Product.objects.bulk_create([
+            Product(category=self.shirt.category, name='Sumka', price=50, description='Teri')
+        ])
+        self.assertEqual(self.search('sumka'), [])
+
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(len(self.search('sumka')), 1)
+
+
+class TotalStockTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        category = Category.objects.create(name='Kiyimlar')
+        cls.small, cls.large = Size.objects.create(name='S'), Size.objects.create(name='L')
+        cls.product = Product.objects.create(category=category, name="Ko'ylak", price=100, description='...')
+
+    def test_size_writes_keep_total_stock_exact(self):
+        small = ProductSize.objects.create(product=self.product, size=self.small, count=4)
+        large = ProductSize.objects.create(product=self.product, size=self.large, count=6)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 10)
+
+        small.count = 1
+        small.save()
+        large.delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 1)
+
+    def test_deduct_and_restore_update_total_stock(self):
+        size = ProductSize.objects.create(product=self.product, size=self.small, count=5)
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, size=size, quantity=3)
+
+        OrderItem.deduct_stock(order)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 2)
+
+        OrderItem.restore_stock(order)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 5)
+
+    def test_deduct_takes_fixed_queries_and_rolls_back_on_shortage(self):
+        sizes = [ProductSize.objects.create(product=self.product, size=size, count=5)
+                 for size in (self.small, self.large)]
+        order = Order.objects.create(user=self.user)
+        for size in sizes * 2:
+            OrderItem.objects.create(order=order, product=self.product, size=size, quantity=1)
+
+        with self.assertNumQueries(9):  # savepoints, claim, lines, update, ledger, total_stock, version, holds
+            OrderItem.deduct_stock(order)
+        self.assertEqual([size.count for size in ProductSize.objects.order_by('id')], [3, 3])
+        with self.assertRaisesMessage(ValueError, 'already deducted'):
+            OrderItem.deduct_stock(order)
+
+        greedy = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=greedy, product=self.product, size=sizes[0], quantity=2)
+        OrderItem.objects.bulk_create([OrderItem(order=greedy, product=self.product, size=sizes[1], quantity=4)])
+        with self.assertRaisesMessage(ValueError, "Not enough stock for L of Ko'ylak"):
+            OrderItem.deduct_stock(greedy)
+        greedy.refresh_from_db()
+        self.assertFalse(greedy.is_paid)
+        self.assertEqual([size.count for size in ProductSize.objects.order_by('id')], [3, 3])
+
+    def test_restore_ignores_unpaid_orders(self):
+        size = ProductSize.objects.create(product=self.product, size=self.small, count=5)
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, size=size, quantity=3)
+
+        self.assertFalse(OrderItem.restore_stock(order))
+        size.refresh_from_db()
+        self.assertEqual(size.count, 5)
+
+    def test_reconcile_repairs_drift(self):
+        ProductSize.objects.create(product=self.product, size=self.small, count=5)
+        Product.objects.filter(pk=self.product.pk).update(total_stock=42)
+
+        call_command('reconcile_stock', '--dry-run', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 42)
+
+        call_command('reconcile_stock', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.total_stock, 5)
+
+    def test_in_stock_filter_reads_the_column(self):
+        ProductSize.objects.create(product=self.product, size=self.small, count=0)
+
+        response = self.client.get(reverse('product-list'), {'in_stock': '1'})
+
+        self.assertEqual(response.data['results'], [])
+
+
+class StockLedgerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        category = Category.objects.create(name='Kiyimlar')
+        cls.product = Product.objects.create(category=category, name="Ko'ylak", price=100, description='...')
+        cls.size = ProductSize.objects.create(product=cls.product, size=Size.objects.create(name='S'), count=5)
+
+    def ledger_count(self):
+        return ProductSize.objects.annotate(ledger=ProductSize.ledger_count()).get(pk=self.size.pk).ledger
+
+    def test_every_change_is_recorded(self):
+        self.size.count = 8
+        self.size.save()
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, size=self.size, quantity=3)
+        OrderItem.deduct_stock(order)
+        OrderItem.restore_stock(order)
+
+        self.assertEqual(list(self.size.movements.order_by('id').values_list('delta', 'reason', 'order')), [
+            (5, StockMovement.ADJUST, None), (3, StockMovement.ADJUST, None),
+            (-3, StockMovement.SALE, order.pk), (3, StockMovement.REFUND, order.pk),
+        ])
+        self.assertEqual(self.ledger_count(), 8)
+
+    def test_compaction_keeps_the_derived_count(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.product, size=self.size, quantity=2)
+        OrderItem.deduct_stock(order)
+
+        call_command('compact_stock_ledger', stdout=StringIO())
+        snapshot = StockSnapshot.objects.get(size=self.size)
+        self.assertEqual((snapshot.count, snapshot.position), (3, StockMovement.objects.latest('id').pk))
+        self.assertEqual(self.ledger_count(), 3)
+
+        self.size.count = 10
+        self.size.save()
+        self.assertEqual(self.ledger_count(), 10)
+        self.assertEqual(StockSnapshot.compact(), 1)
+        self.assertEqual(StockSnapshot.compact(), 0)
+
+        StockMovement.objects.update(created_at=timezone.now() - timedelta(days=40))
+        call_command('compact_stock_ledger', '--keep-days', '30', stdout=StringIO())
+        self.assertFalse(StockMovement.objects.exists())
+        self.assertEqual(self.ledger_count(), 10)
+
+    def test_reconcile_books_drift_into_the_ledger(self):
+        ProductSize.objects.filter(pk=self.size.pk).update(count=7)  # Bypasses the ledger
+
+        call_command('reconcile_stock', '--dry-run', stdout=StringIO())
+        self.assertEqual(self.ledger_count(), 5)
+
+        call_command('reconcile_stock', stdout=StringIO())
+        self.assertEqual(self.ledger_count(), 7)
+        self.assertEqual(StockMovement.objects.latest('id').delta, 2)
+
+
+class ShardedStockTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        category = Category.objects.create(name='Kiyimlar')
+        cls.product = Product.objects.create(category=category, name="Ko'ylak", price=100, description='...')
+        cls.size = ProductSize.objects.create(product=cls.product, size=Size.objects.create(name='S'), count=10)
+
+    def shard_counts(self):
+        return list(self.size.stock_shards.order_by('slot').values_list('count', flat=True))
+
+    def order(self, quantity):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=self.product, size=self.size, quantity=quantity)])
+        return order
+
+    def test_sharding_splits_and_merges_the_stock(self):
+        self.size.shard(4)
+        self.assertEqual(self.shard_counts(), [3, 3, 2, 2])
+        self.assertEqual(self.size.available_count(), 10)
+
+        self.size.shard(1)
+        self.size.refresh_from_db()
+        self.assertEqual((self.size.count, self.size.shards, self.shard_counts()), (10, 0, []))
+
+    def test_deduct_spills_over_and_refreshes_count_after_commit(self):
+        self.size.shard(4)
+        order = self.order(5)  # More than any single shard
+
+        with self.captureOnCommitCallbacks(execute=True):
+            OrderItem.deduct_stock(order)
+            self.size.refresh_from_db()
+            self.assertEqual(self.size.count, 10)  # Hot row untouched until commit
+        self.assertEqual(sum(self.shard_counts()), 5)
+        self.size.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((self.size.count, self.product.total_stock), (5, 5))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            OrderItem.restore_stock(order)
+        self.assertEqual(sum(self.shard_counts()), 10)
+        self.assertEqual(list(self.size.movements.values_list('delta', flat=True).order_by('id')), [10, -5, 5])
+
+    def test_shortage_rolls_back_every_shard(self):
+        self.size.shard(4)
+        StockShard.objects.filter(size=self.size, slot=0).update(count=0)
+        order = self.order(9)
+
+        with self.assertRaises(ValueError):
+            OrderItem.deduct_stock(order)
+        self.assertEqual(self.shard_counts(), [0, 3, 2, 2])
+        order.refresh_from_db()
+        self.assertFalse(order.is_paid)
+
+    def test_reconcile_uses_the_shards_of_a_missed_refresh(self):
+        self.size.shard(4)
+        OrderItem.deduct_stock(self.order(3))  # The refresh after commit never runs
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 10)
+
+        out = StringIO()
+        call_command('reconcile_stock', stdout=out)
+        self.size.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((self.size.count, self.product.total_stock), (7, 7))
+        self.assertFalse(self.size.movements.filter(reason=StockMovement.ADJUST).exclude(delta=10).exists())
+        self.assertIn('No drift found', out.getvalue())
+
+    def test_rebalance_and_admin_edits(self):
+        self.size.shard(2)
+        StockShard.objects.filter(size=self.size, slot=0).update(count=0)
+
+        call_command('rebalance_stock_shards', stdout=StringIO())
+        self.assertEqual(self.shard_counts(), [3, 2])
+        call_command('rebalance_stock_shards', '--size', str(self.size.pk), '--shards', '3', stdout=StringIO())
+        self.assertEqual(self.shard_counts(), [2, 2, 1])
+
+        self.size.refresh_from_db()
+        self.size.count = 9
+        self.size.save()
+        self.assertEqual(self.shard_counts(), [3, 3, 3])
+
+
+class CatalogCacheTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.other = User.objects.create(username='654321')
+        cls.category = create_catalog(products=30)
+        cls.product = Product.objects.order_by('id').first()
+        LikeDislike.objects.create(product=cls.product, user=cls.user.username, is_like=True)
+
+    def test_cache_hit_skips_serialization(self):
+        params = {'price_filter': 'aasc'}
+        self.client.get(reverse('product-list'), params)
+
+        # catalog version, likes come from the liked cache
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('product-list'), params)
+        self.assertEqual(len(response.data['results']), 20)
+
+    def test_likes_are_overlaid_per_user(self):
+        params = {'price_filter': 'aasc'}
+        mine = self.client.get(reverse('product-list'), params).data['results']
+
+        self.client.force_authenticate(self.other)
+        theirs = self.client.get(reverse('product-list'), params).data['results']
+
+        self.assertTrue(mine[0]['liked_by_user'])
+        self.assertFalse(theirs[0]['liked_by_user'])
+        self.assertEqual([item['id'] for item in mine], [item['id'] for item in theirs])
+
+    def test_likes_from_other_processes_reload_the_liked_cache(self):
+        params = {'price_filter': 'aasc'}
+        self.client.get(reverse('product-list'), params)
+        # As if toggled by another worker: no invalidation in this process
+        LikeDislike.toggle(self.user.username, self.product.pk)
+
+        response = self.client.get(reverse('product-list'), params)
+        self.assertFalse(response.data['results'][0]['liked_by_user'])
+
+    def test_catalog_writes_invalidate_cached_pages(self):
+        url = reverse('product-detail', args=[self.product.id])
+        self.assertEqual(self.client.get(url).data['name'], self.product.name)
+
+        self.product.name = 'Yangi nom'
+        self.product.save()
+        self.assertEqual(self.client.get(url).data['name'], 'Yangi nom')
+
+        size = self.product.productsize_set.first()
+        size.count += 10
+        size.save()
+        self.assertEqual(self.client.get(url).data['total_count'], self.product.total_count() + 10)
+
+    def test_category_payloads_are_cached_with_overlay(self):
+        self.client.get(reverse('all-categories'))
+        self.client.get(reverse('category-products', args=[self.category.id]))
+
+        with self.assertNumQueries(1):
+            self.client.get(reverse('all-categories'))
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('category-products', args=[self.category.id]))
+        liked = [item['id'] for item in response.data['products'] if item['liked_by_user']]
+        self.assertEqual(liked, [self.product.id])
+
+
+class ConditionalGetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456', first_name='Ali')
+        cls.category = create_catalog(products=30)
+        cls.product = Product.objects.order_by('id').first()
+
+    def assertNotModified(self, url, params=None, serializer=ProductSerializer):
+        etag = self.client.get(url, params)['ETag']
+
+        with mock.patch.object(serializer, 'to_representation') as to_representation:
+            with self.assertNumQueries(1):
+                response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        to_representation.assert_not_called()
+        return etag
+
+    def test_catalog_endpoints_short_circuit(self):
+        self.assertNotModified(reverse('product-list'))  # The feed a user opens by default
+        self.assertNotModified(reverse('product-list'), {'price_filter': 'aasc'})
+        self.assertNotModified(reverse('product-detail', args=[self.product.id]))
+        self.assertNotModified(reverse('all-categories'), serializer=CategorySerializer)
+        self.assertNotModified(reverse('category-products', args=[self.category.id]), serializer=CategorySerializer)
+
+    def test_catalog_writes_and_likes_change_the_etag(self):
+        url = reverse('product-detail', args=[self.product.id])
+        etag = self.client.get(url)['ETag']
+
+        LikeDislike.objects.create(product=self.product, user=self.user.username, is_like=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['liked_by_user'])
+
+        etag = response['ETag']
+        self.product.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_active_order_short_circuits(self):
+        order = Order.objects.create(user=self.user)
+        size = self.product.productsize_set.filter(count__gt=0).first()
+        OrderItem.objects.create(order=order, product=self.product, size=size, quantity=1)
+        url = reverse('get_active_order')
+
+        etag = self.assertNotModified(url, serializer=OrderSerializer)
+
+        OrderItem.objects.filter(order=order).first().delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class SparseFieldsetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.category = create_catalog(products=30)
+        Category.objects.create(name='Bo\'sh')
+
+    def test_category_list_is_lean(self):
+        # catalog state + one annotated query
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('all-categories'))
+
+        self.assertEqual(response.data, [
+            {'id': self.category.id, 'name': self.category.name, 'product_count': 30},
+            {'id': self.category.id + 1, 'name': "Bo'sh", 'product_count': 0},
+        ])
+
+    def test_category_list_can_expand_products(self):
+        response = self.client.get(reverse('all-categories'), {'expand': 'products', 'fields': 'name'})
+
+        self.assertEqual(len(response.data[0]['products']), 30)
+        self.assertEqual(set(response.data[0]['products'][0]), {'id', 'name'})
+
+    def test_fields_trim_payload_and_queries(self):
+        # catalog state + products, no sizes prefetch and no like overlay
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('product-list'), {'price_filter': 'aasc', 'fields': 'name,price'})
+
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name', 'price'})
+
+    def test_expand_category(self):
+        product = Product.objects.first()
+
+        response = self.client.get(reverse('product-detail', args=[product.id]), {'expand': 'category'})
+
+        self.assertEqual(response.data['category'], {'id': self.category.id, 'name': self.category.name})
+
+
+class NotificationViewedTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        viewers = User.objects.bulk_create([User(username=str(i)) for i in range(50)])
+        cls.notifications = Notification.objects.bulk_create([
+            Notification(title=f"Xabar {i}", message='...') for i in range(5)
+        ])
+        for notification in cls.notifications:
+            notification.viewed_by_user.add(*viewers)
+        cls.notifications[0].viewed_by_user.add(cls.user)
+
+    def test_list_cost_does_not_grow_with_viewers(self):
+        for fast in (False, True):
+            with self.subTest(fast=fast), override_settings(FAST_READ_SERIALIZERS=fast):
+                with self.assertNumQueries(1):
+                    response = self.client.get(reverse('notifications'))
+
+                viewed = {item['id']: item['has_viewed'] for item in response.json()['results']}
+                self.assertEqual(viewed, {n.pk: n == self.notifications[0] for n in self.notifications})
+                self.assertNotIn('viewed_by_user', response.json()['results'][0])
+
+    def test_reading_marks_viewed(self):
+        url = reverse('get_notification_and_mark_read', args=[self.notifications[1].pk])
+
+        first = self.client.get(url).json()
+        second = self.client.get(url).json()
+
+        self.assertEqual((first['has_viewed'], first['notification']['has_viewed']), (False, True))
+        self.assertTrue(second['has_viewed'])
+        self.assertEqual(self.notifications[1].viewed_by_user.count(), 51)
+
+
+class UnreadNotificationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.other = User.objects.create(username='654321')
+        cls.notifications = [Notification.objects.create(title=f"Xabar {i}", message='...') for i in range(4)]
+        cls.notifications[0].viewed_by_user.add(cls.user)
+
+    def unread(self):
+        return self.client.get(reverse('unread_notification_count')).json()['unread']
+
+    def test_counter_follows_new_notifications_and_reads(self):
+        self.assertEqual(self.unread(), 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.unread(), 3)
+
+        Notification.objects.create(title='Yangi', message='...')
+        self.assertEqual(self.unread(), 4)
+
+        self.client.get(reverse('get_notification_and_mark_read', args=[self.notifications[1].pk]))
+        self.client.get(reverse('get_notification_and_mark_read', args=[self.notifications[1].pk]))
+        self.assertEqual(self.unread(), 3)
+
+        self.user.viewed_notifications.add(self.notifications[2], self.notifications[3])
+        self.assertEqual(self.unread(), 1)
+        self.notifications[3].delete()
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(UnreadNotifications.recount(self.user), 1)
+
+    def test_removing_and_clearing_reads(self):
+        self.assertEqual(self.unread(), 3)
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.unread(), 4)
+        self.notifications[1].viewed_by_user.add(self.user, self.other)
+
+        self.notifications[2].viewed_by_user.remove(self.user, self.other)  # Never read by either
+        self.user.viewed_notifications.remove(self.notifications[3])
+        self.assertEqual(self.unread(), 3)
+
+        self.notifications[1].viewed_by_user.clear()
+        self.user.viewed_notifications.clear()
+        self.assertEqual(self.unread(), 4)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.unread(), 4)
+        self.assertEqual([UnreadNotifications.recount(user) for user in (self.user, self.other)], [4, 4])
+
+    def test_mark_all_read_is_one_insert(self):
+        self.assertEqual(self.unread(), 3)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('mark_all_notifications_read'))
+        inserts = [query['sql'] for query in context.captured_queries if query['sql'].startswith('INSERT')]
+
+        self.assertEqual(response.json(), {'marked': 3, 'unread': 0})
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.unread(), 0)
+        self.assertEqual(self.user.viewed_notifications.count(), 4)
+        self.assertEqual(self.other.viewed_notifications.count(), 0)
+
+
+class FastSerializerParityTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.other = User.objects.create(username='654321')
+        create_catalog(products=40)
+        Product.objects.filter(id__in=Product.objects.order_by('id').values('id')[:5]).update(image='products/Image_2.jpg')
+        for product in Product.objects.order_by('id')[:15:2]:
+            LikeDislike.objects.create(product=product, user=cls.user.username, is_like=True)
+
+        notifications = Notification.objects.bulk_create([
+            Notification(title=f"Xabar {i}", message=f"Matn {i}") for i in range(12)
+        ])
+        for notification in notifications[::3]:
+            notification.viewed_by_user.add(cls.user, cls.other)
+
+        order = Order.objects.create(user=cls.user)
+        for product in Product.objects.order_by('id')[:6]:
+            size = product.productsize_set.order_by('-count').first()
+            OrderItem.objects.create(order=order, product=product, size=size, quantity=1)
+
+    def assertParity(self, url, params=None):
+        responses = []
+        for fast in (False, True):
+            cache.clear()
+            with override_settings(FAST_READ_SERIALIZERS=fast):
+                responses.append(self.client.get(url, params))
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[0].content, responses[1].content)
+
+    def test_product_pages(self):
+        self.assertParity(reverse('product-list'), {'seed': 'a'})
+        self.assertParity(reverse('product-list'), {'price_filter': 'desc', 'page_size': 50})
+        self.assertParity(reverse('product-list'), {'search': 'mahsulot 1'})
+
+    def test_liked_products(self):
+        self.assertParity(reverse('liked-products'))
+
+    def test_notifications(self):
+        self.assertParity(reverse('notifications'), {'page_size': 5})
+        self.assertParity(reverse('notifications'))
+
+    def test_active_order(self):
+        self.assertParity(reverse('get_active_order'))
+
+    def test_benchmark_command_reports_parity(self):
+        out = StringIO()
+        call_command('benchmark_serializers', rows=20, repeat=2, stdout=out)
+
+        self.assertNotIn('MISMATCH', out.getvalue())
+        self.assertEqual(out.getvalue().count(' ok'), 3)
+
+
+class EndpointBenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def run_benchmark(self, **options):
+        with redirect_stdout(StringIO()):  # the views print
+            call_command('benchmark_endpoints', iterations=2, warmup=0, stdout=StringIO(), **options)
+
+    def test_seed_and_benchmark_every_route(self):
+        call_command('seed_catalog', categories=2, products=30, users=5, likes=20, orders=5, notifications=3,
+                     stdout=StringIO())
+        self.assertEqual(Product.objects.count(), 30)
+        self.assertEqual(ProductSize.objects.filter(product__total_stock=0, count__gt=0).count(), 0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.json')
+            self.run_benchmark(output=output)
+            with open(output) as file:
+                report = json.load(file)
+
+            self.assertEqual(report['not_covered'], [])
+            self.assertEqual(report['data']['products'], 30)
+            for label, result in report['routes'].items():
+                self.assertTrue(all(code < 500 for code in result['status']), label)
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            # Writes are rolled back
+            self.assertFalse(User.objects.filter(username__startswith='benchmark-').exists())
+
+            report['routes']['api-root']['queries'] -= 1
+            with open(output, 'w') as file:
+                json.dump(report, file)
+            with self.assertRaisesMessage(CommandError, 'api-root'):
+                self.run_benchmark(compare=output, threshold=1000)
+
+
+class StockHoldTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.other = User.objects.create(username='654321')
+        category = Category.objects.create(name='Kiyimlar')
+        cls.product = Product.objects.create(category=category, name="Ko'ylak", price=100, description='...')
+        cls.size = ProductSize.objects.create(product=cls.product, size=Size.objects.create(name='S'), count=5)
+
+    def add(self, user, quantity):
+        self.client.force_authenticate(user)
+        return self.client.post(reverse('add_order_item'),
+                                {'product_id': self.product.pk, 'size_id': self.size.pk, 'quantity': quantity})
+
+    def test_cart_holds_stock_until_it_expires(self):
+        self.assertEqual(self.add(self.user, 4).status_code, 201)
+        self.assertEqual(self.size.available_count(), 1)
+
+        response = self.add(self.other, 2)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Only 1 items available', response.data['message'])
+        self.assertFalse(Order.objects.filter(user=self.other).exists())  # Turned away before the cart is made
+        request = Request(APIRequestFactory().post('/'))
+        request.user = self.other
+        serializer = AddOrderItemSerializer(data={'product': self.product.pk, 'size': self.size.pk, 'quantity': 2},
+                                            context={'request': request})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('Only 1 items are available', str(serializer.errors))
+
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.size.available_count(), 5)
+        self.assertEqual(self.add(self.other, 2).status_code, 201)
+
+        out = StringIO()
+        call_command('release_stock_holds', batch_size=1, stdout=out)
+        self.assertIn('Released 1 expired holds', out.getvalue())
+        self.assertEqual(list(StockHold.objects.values_list('order__user', 'quantity')), [(self.other.pk, 2)])
+
+    def test_sweeper_keeps_running_and_reports_only_releases(self):
+        self.add(self.user, 4)
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        # The third sleep stops the loop
+        with mock.patch('app.management.commands._interval.time.sleep', side_effect=[None, None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('release_stock_holds', interval=5, stdout=out)
+
+        self.assertEqual(out.getvalue(), 'Released 1 expired holds\n')
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_checkout_respects_other_carts_holds(self):
+        self.add(self.user, 4)
+        lapsed = Order.objects.get(user=self.user)
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.add(self.other, 3)
+        holder = Order.objects.get(user=self.other)
+
+        with self.assertRaisesMessage(ValueError, "Not enough stock for S of Ko'ylak"):
+            OrderItem.deduct_stock(lapsed)
+
+        OrderItem.deduct_stock(holder)
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 2)
+        self.assertFalse(StockHold.objects.filter(order=holder).exists())
+
+
+class OrderTotalTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456', is_staff=True, is_superuser=True)
+        create_catalog(products=6)
+        cls.sizes = list(ProductSize.objects.filter(count__gt=2).select_related('product'))
+
+    def create_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(user=self.user, is_paid=True)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=size.product, size=size, quantity=2) for size in self.sizes[:3]
+            ])
+
+    def test_annotation_matches_the_python_sum(self):
+        self.create_orders(3)
+        Order.objects.create(user=self.user)
+        expected = {order.pk: sum(item.quantity * item.product.price for item in order.items.all())
+                    for order in Order.objects.all()}
+
+        with self.assertNumQueries(1):
+            totals = {order.pk: order.total_price for order in Order.objects.with_total()}
+        self.assertEqual(totals, expected)
+        self.assertEqual(Order.objects.order_by('id').first().total_price, next(iter(expected.values())))
+
+    def test_admin_order_list_query_count_is_flat(self):
+        self.client.force_login(self.user)
+        url = reverse('admin:app_order_changelist')
+        self.create_orders(2)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        self.create_orders(10)
+        with self.assertNumQueries(len(few)):
+            response = self.client.get(url, {'o': '3'})  # sorted by total price
+        self.assertEqual(response.status_code, 200)
+
+
+class BatchOrderItemsTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        create_catalog(products=30)
+        ProductSize.objects.update(count=5)
+        cls.sizes = list(ProductSize.objects.order_by('id'))
+
+    def batch(self, *operations):
+        return self.client.post(reverse('batch_order_items'), {'operations': list(operations)}, format='json')
+
+    def test_applies_operations_in_order(self):
+        order = Order.objects.create(user=self.user)
+        kept = OrderItem.objects.create(order=order, product=self.sizes[0].product, size=self.sizes[0], quantity=1)
+        dropped = OrderItem.objects.create(order=order, product=self.sizes[1].product, size=self.sizes[1], quantity=1)
+
+        response = self.batch(
+            {'op': 'add', 'size_id': self.sizes[0].pk, 'quantity': 1},
+            {'op': 'remove', 'order_item_id': dropped.pk},
+            {'op': 'add', 'size_id': self.sizes[2].pk, 'product_id': self.sizes[2].product_id, 'quantity': 3},
+            {'op': 'update', 'order_item_id': kept.pk, 'quantity': 3},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        lines = [(line['size']['id'], line['quantity']) for line in response.data['items']]
+        self.assertEqual(lines, [(self.sizes[0].pk, 3), (self.sizes[2].pk, 3)])
+        self.assertEqual(dict(StockHold.objects.values_list('size', 'quantity')),
+                         {self.sizes[0].pk: 3, self.sizes[2].pk: 3})
+
+    def test_repeated_adds_of_a_new_size_make_one_line(self):
+        response = self.batch(
+            {'op': 'add', 'size_id': self.sizes[0].pk},
+            {'op': 'add', 'size_id': self.sizes[0].pk, 'quantity': 2},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(line['size']['id'], line['quantity']) for line in response.data['items']],
+                         [(self.sizes[0].pk, 3)])
+        self.assertEqual(list(StockHold.objects.values_list('size', 'quantity')), [(self.sizes[0].pk, 3)])
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        def edit(sizes):
+            return self.batch(*({'op': 'add', 'size_id': size.pk} for size in sizes))
+
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(edit(self.sizes[:2]).status_code, 200)
+        Order.objects.all().delete()
+        with self.assertNumQueries(len(small)):
+            self.assertEqual(edit(self.sizes[:20]).status_code, 200)
+
+    def test_rejects_the_whole_batch(self):
+        response = self.batch(
+            {'op': 'add', 'size_id': self.sizes[0].pk, 'quantity': 1},
+            {'op': 'add', 'size_id': self.sizes[1].pk, 'quantity': 100},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(self.sizes[1].pk, response.data['stock'])
+        self.assertFalse(OrderItem.objects.exists())
+
+        response = self.batch({'op': 'update', 'order_item_id': 999, 'quantity': 1}, {'op': 'remove'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('order_item_id', response.data['operations'][1])
+
+
+class ActiveOrderQueryTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        create_catalog(products=12)
+        cls.sizes = list(ProductSize.objects.select_related('product').order_by('id'))
+        cls.order = Order.objects.create(user=cls.user)
+
+    def setUp(self):
+        super().setUp()
+        views.payment_link.cache_clear()
+
+    def add_items(self, count):
+        start = self.order.items.count()
+        OrderItem.objects.bulk_create([
+            OrderItem(order=self.order, product=size.product, size=size, quantity=1)
+            for size in self.sizes[start:start + count]
+        ])
+
+    def test_query_count_does_not_grow_with_the_order(self):
+        for fast in (False, True):
+            with self.subTest(fast=fast), override_settings(FAST_READ_SERIALIZERS=fast):
+                OrderItem.objects.all().delete()
+                self.add_items(2)
+                with CaptureQueriesContext(connection) as small:
+                    self.client.get(reverse('get_active_order'))
+                self.add_items(10)
+                with self.assertNumQueries(len(small)):
+                    response = self.client.get(reverse('get_active_order'))
+                self.assertEqual(len(response.data['order']['items']), 12)
+
+    def test_pay_link_is_built_once_per_total(self):
+        self.add_items(2)
+        with mock.patch.object(views.payme.initializer, 'generate_pay_link', return_value='link') as generate:
+            first = self.client.get(reverse('get_active_order'))
+            self.client.get(reverse('get_active_order'))
+            self.assertEqual(generate.call_count, 1)
+
+            self.add_items(1)
+            self.client.get(reverse('get_active_order'))
+            self.assertEqual(generate.call_count, 2)
+        self.assertEqual(first.data['payment_link'], 'link')
+
+
+@mock.patch('payme.views.base.track_successful_transaction')
+class PaymeWebhookTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        category = Category.objects.create(name='Kiyimlar')
+        product = Product.objects.create(category=category, name="Ko'ylak", price=100, description='...')
+        cls.size = ProductSize.objects.create(product=product, size=Size.objects.create(name='S'), count=5)
+        cls.order = Order.objects.create(user=cls.user)
+        OrderItem.objects.create(order=cls.order, product=product, size=cls.size, quantity=3)
+
+    def call(self, method, **params):
+        auth = base64.b64encode(f"Paycom:{settings.PAYME_KEY}".encode()).decode()
+        body = {'id': 1, 'method': method, 'params': {'id': 'tx-1', **params}}
+        return self.client.post(reverse('payment_callback'), body, content_type='application/json',
+                                HTTP_AUTHORIZATION=f'Basic {auth}')
+
+    def create(self):
+        self.call('CreateTransaction', time=1, amount=30000, account={'order_id': self.order.pk})
+
+    def run_jobs(self):
+        call_command('run_jobs', once=True, stdout=StringIO())
+
+    def test_retried_perform_is_answered_from_the_ledger(self, track):
+        self.create()
+        first = self.call('PerformTransaction')
+        with self.assertNumQueries(1):
+            retry = self.call('PerformTransaction')
+
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(first.json()['result']['state'], 2)
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 5)  # Fulfilment is queued
+
+        self.run_jobs()
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 2)
+        self.assertEqual(sorted(Job.objects.values_list('kind', 'status')),
+                         [('fulfil_order', Job.DONE), ('notify_order_paid', Job.DONE)])
+
+        self.call('CancelTransaction', reason=5)
+        self.call('CancelTransaction', reason=5)
+        self.run_jobs()
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 5)
+        self.assertEqual(PaymeEvent.objects.count(), 2)
+
+    def test_cancel_before_perform_keeps_stock(self, track):
+        self.create()
+        response = self.call('CancelTransaction', reason=3)
+
+        self.assertEqual(response.json()['result']['state'], -1)
+        self.assertFalse(Job.objects.exists())
+
+    def test_failed_fulfilment_is_retried_with_backoff(self, track):
+        self.create()
+        ProductSize.objects.filter(pk=self.size.pk).update(count=1)
+
+        self.assertEqual(self.call('PerformTransaction').json()['result']['state'], 2)
+        self.run_jobs()
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 1))
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertIn('Not enough stock', job.last_error)
+
+        ProductSize.objects.filter(pk=self.size.pk).update(count=5)
+        Job.objects.update(run_at=timezone.now())
+        self.run_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DONE, 2))
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 2)
+
+    def test_jobs_of_dead_workers_run_again_without_repeating_work(self, track):
+        self.create()
+        self.call('PerformTransaction')
+        self.run_jobs()
+        # The worker died after deducting but before marking the job done
+        Job.objects.filter(kind='fulfil_order').update(status=Job.RUNNING,
+                                                       locked_until=timezone.now() - timedelta(seconds=1))
+
+        self.run_jobs()
+        self.assertEqual(Job.objects.get(kind='fulfil_order').status, Job.DONE)
+        self.size.refresh_from_db()
+        self.assertEqual(self.size.count, 2)
+
+    def test_deduction_and_notification_job_commit_together(self, track):
+        self.create()
+        self.call('PerformTransaction')
+        with mock.patch('app.jobs.Job.enqueue', side_effect=RuntimeError('database is locked')):
+            self.run_jobs()
+
+        self.order.refresh_from_db()
+        self.size.refresh_from_db()
+        self.assertEqual((self.order.is_paid, self.size.count), (False, 5))
+        self.assertEqual(Job.objects.get().status, Job.PENDING)
+
+        Job.objects.update(run_at=timezone.now())
+        self.run_jobs()
+        self.assertEqual(sorted(Job.objects.values_list('kind', 'status')),
+                         [('fulfil_order', Job.DONE), ('notify_order_paid', Job.DONE)])
+
+    @override_settings(TELEGRAM_BOT_TOKEN='token')
+    def test_customer_is_notified(self, track):
+        Job.enqueue('notify_order_paid', order_id=self.order.pk)
+        with mock.patch('app.jobs.requests.post') as post:
+            self.run_jobs()
+
+        self.assertEqual(post.call_args.kwargs['data']['chat_id'], '123456')
+        self.assertEqual(Job.objects.get().status, Job.DONE)
+
+
+@override_settings(PAYMENT_STATUS_POLL=60)  # Only a wake-up can end the wait early
+class PaymentStatusLongPollTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='123456')
+        cls.token = Token.objects.create(user=cls.user)
+        cls.order = Order.objects.create(user=cls.user)
+
+    def wait(self, timeout, **headers):
+        return self.async_client.get(reverse('wait_payment_status'), {'order_id': self.order.pk, 'timeout': timeout},
+                                     headers={'Authorization': f'Token {self.token.key}', **headers})
+
+    async def test_paid_order_answers_at_once(self):
+        await Order.objects.filter(pk=self.order.pk).aupdate(is_paid=True)
+        start = time.monotonic()
+        response = await self.wait(30)
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.json()['payment_status'], 'success')
+
+    async def test_pending_order_answers_after_timeout(self):
+        response = await self.wait(0.1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['payment_status'], 'pending')
+
+    async def test_waiter_wakes_when_order_is_paid(self):
+        async def pay():
+            await asyncio.sleep(0.2)
+            await Order.objects.filter(pk=self.order.pk).aupdate(is_paid=True)
+            order_events.notify_paid(self.order.pk)
+
+        start = time.monotonic()
+        response, _ = await asyncio.gather(self.wait(30), pay())
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response.json()['payment_status'], 'success')
+
+    @override_settings(PAYMENT_STATUS_POLL=0.05)
+    async def test_payment_by_another_process_wakes_all_waiters(self):
+        orders = [self.order] + [await Order.objects.acreate(user=self.user) for _ in range(2)]
+
+        async def wait(order):
+            return await self.async_client.get(reverse('wait_payment_status'), {'order_id': order.pk, 'timeout': 30},
+                                               headers={'Authorization': f'Token {self.token.key}'})
+
+        async def pay():
+            await asyncio.sleep(0.2)
+            self.assertEqual(len(order_events._watchers), 1)  # One watcher for every waiter
+            # Like the run_jobs worker: the test transaction never commits, so no notify_paid() here
+            for order in orders:
+                await sync_to_async(OrderItem.deduct_stock)(order)
+
+        start = time.monotonic()
+        *responses, _ = await asyncio.gather(*map(wait, orders), pay())
+
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual([response.json()['payment_status'] for response in responses], ['success'] * 3)
+        self.assertEqual(order_events._watchers, {})
+
+    def test_stock_deduction_notifies_on_commit(self):
+        with mock.patch.object(order_events, 'notify_paid') as notify:
+            with self.captureOnCommitCallbacks(execute=True):
+                OrderItem.deduct_stock(self.order)
+                notify.assert_not_called()
+
+        notify.assert_called_once_with(self.order.pk)
+
+    async def test_requires_token(self):
+        response = await self.wait(0, Authorization='Token wrong')
+        self.assertEqual(response.status_code, 401)
+
+        response = await self.async_client.get(reverse('wait_payment_status'), {'order_id': self.order.pk})
+        self.assertEqual(response.status_code, 401)
+
+
+class StockConcurrencyTests(TransactionTestCase):
+    @override_settings(STOCK_HOLD_TTL=0)  # Carts whose holds have lapsed
+    def test_concurrent_confirmations_never_oversell(self):
+        self.confirm_concurrently(shards=0)
+
+    @override_settings(STOCK_HOLD_TTL=0)
+    def test_concurrent_confirmations_never_oversell_sharded_stock(self):
+        self.confirm_concurrently(shards=3)
+
+    def test_shard_benchmark_runs_and_cleans_up(self):
+        out = StringIO()
+        call_command('benchmark_stock_shards', '--threads', '2', '--orders', '3', '--shards', '2', stdout=out)
+
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+        self.assertFalse(Product.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+    def confirm_concurrently(self, shards):
+        user = User.objects.create(username='123456')
+        product = Product.objects.create(category=Category.objects.create(name='Kiyimlar'), name="Ko'ylak",
+                                         price=100, description='...')
+        size = ProductSize.objects.create(product=product, size=Size.objects.create(name='S'), count=5)
+        size.shard(shards)
+        orders = [Order.objects.create(user=user) for _ in range(12)]
+        for order in orders:
+            OrderItem.objects.create(order=order, product=product, size=size, quantity=1)
+        # Every order is confirmed twice, as Payme retries do
+        attempts = orders * 2
+        barrier = threading.Barrier(len(attempts))
+        results = []
+
+        def confirm(order):
+            barrier.wait()
+            try:
+                while True:
+                    try:
+                        OrderItem.deduct_stock(Order.objects.get(pk=order.pk))
+                        results.append(order.pk)
+                        return
+                    except ValueError:
+                        return
+                    except OperationalError:  # SQLite's shared-cache test database is locked, retry
+                        time.sleep(0.001)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=confirm, args=(order,)) for order in attempts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(StockShard.objects.exclude(count=0).exists())
+        StockShard.refresh_totals([size.pk])  # In case a refresh after commit lost the lock
+        size.refresh_from_db()
+        product.refresh_from_db()
+        self.assertEqual(size.count, 0)
+        self.assertEqual(product.total_stock, 0)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(set(results)), 5)
+        self.assertEqual(Order.objects.filter(is_paid=True).count(), 5)
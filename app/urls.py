@@ -14,19 +14,24 @@ urlpatterns = [
     path('categories/', views.CategoryListView.as_view(), name='all-categories'),
 
     path('products/like/<int:product_id>/', views.LikeProductView.as_view(), name='like_product'),
+    path('products/like/status/', views.LikeStatusView.as_view(), name='like_status'),
     path('liked-products/', views.LikedProductsView.as_view(), name='liked-products'),
 
     path('order/add/', views.AddOrderItemView.as_view(), name='add_order_item'),
     path('order/remove/<int:order_item_id>', views.RemoveOrderItemView.as_view(), name='remove_order_item'),
     path('order/update/', views.UpdateOrderItemView.as_view(), name='update_order_item'),
+    path('order/batch/', views.BatchOrderItemsView.as_view(), name='batch_order_items'),
 
     path('order/active/', views.GetActiveOrderView.as_view(), name='get_active_order'),
 
     path('notifications/', views.NotificationListView.as_view(), name='notifications'),
+    path('notifications/unread-count/', views.UnreadNotificationCountView.as_view(), name='unread_notification_count'),
+    path('notifications/read-all/', views.MarkAllNotificationsReadView.as_view(), name='mark_all_notifications_read'),
     path('notification/<int:notification_id>/', views.get_notification_and_mark_read, name='get_notification_and_mark_read'),
 
     # payment
     path("payme/", views.PaymeCallBackAPIView.as_view(), name='payment_callback'),
     path("payme/check-status", views.CheckPaymentStatusView.as_view(), name='update_payment_callback'),
+    path("payme/wait-status", views.wait_payment_status, name='wait_payment_status'),
 
 ]
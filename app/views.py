@@ -1,21 +1,31 @@
 from decimal import Decimal
+from functools import lru_cache
 
+from asgiref.sync import sync_to_async
 from django.contrib.auth import login
 from django.contrib.auth.models import User
+from django.db.models import Count, Prefetch
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 
-from .serializers import CategorySerializer, ProductSerializer, \
+from .serializers import CategorySerializer, CategoryListSerializer, ProductSerializer, query_list, \
     NotificationSerializer, AddOrderItemSerializer, RemoveOrderItemSerializer, UpdateOrderItemSerializer, \
-    OrderSerializer, OrderItemSerializer, OrderStatusSerializer
-from .models import Product, LikeDislike, Category, Notification, Order, OrderItem, ProductSize
-
-from rest_framework import status, viewsets, generics, filters
+    OrderSerializer, OrderItemSerializer, OrderStatusSerializer, BatchOrderItemsSerializer
+from .models import Product, LikeDislike, Category, Notification, Order, OrderItem, ProductSize, PaymeEvent, Job, \
+    UnreadNotifications
+from .pagination import KeysetPagination, ShuffledFeedPagination
+from . import fast_serializers, search, order_events, liked_cache
+from .caching import catalog_response, active_order_validators, not_modified, set_validators
+from .search import ProductSearchFilter
+
+from rest_framework import status, viewsets, generics
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.authtoken.models import Token
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
 
 from payme.views import PaymeWebHookAPIView
 from payme.models import PaymeTransactions
@@ -54,35 +64,80 @@ class UserLoginView(APIView):
         return Response({'message': 'Login failed'}, status=400)
 
 
+def listing_options(request):
+    """Product.objects.for_listing() options matching the request's sparse fieldsets."""
+    return {'fields': query_list(request, 'fields'), 'expand': query_list(request, 'expand')}
+
+
 class ProductViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
-    queryset = Product.objects.order_by("?")
+    queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    filter_backends = [filters.SearchFilter]
-    search_fields = ['name', 'description']
+    filter_backends = [ProductSearchFilter]
+
+    def get_keyset_ordering(self):
+        price_filter = self.request.query_params.get('price_filter')
+        if price_filter == 'aasc':
+            return ('price', 'id')  # Ascending order by price
+        elif price_filter == 'desc':
+            return ('-price', '-id')
+        elif price_filter == 'popular':
+            return ('-popularity', '-id')  # Most liked first, see Product.refresh_popularity
+        elif search.tokenize(ProductSearchFilter().get_search_term(self.request)):
+            return ('search_rank', 'id')  # Most relevant first
+        return None
+
+    @property
+    def paginator(self):
+        """
+        Products are served as a seeded shuffled feed unless a price or popular ordering or a search is requested.
+        """
+        if not hasattr(self, '_paginator'):
+            if self.get_keyset_ordering() is None:
+                self._paginator = ShuffledFeedPagination()
+            else:
+                self._paginator = KeysetPagination()
+        return self._paginator
 
     def get_queryset(self):
         """
-        Optionally filters the queryset by an exact category_name passed as a query parameter.
+        Optionally filters the queryset by an exact category_name passed as a query parameter,
+        and by in_stock=1 to hide sold out products. Ordering is applied by the paginator.
         """
-        queryset = self.queryset
+        queryset = self.queryset.for_listing(**listing_options(self.request))  # Likes are overlaid in list()
         category_name = self.request.query_params.get('category_name')
-        price_filter = self.request.query_params.get('price_filter')
         if category_name:
             queryset = queryset.filter(category__name=category_name)
-        if price_filter == 'aasc':
-            queryset = queryset.order_by('price')  # Ascending order by price
-        elif price_filter == 'desc':
-            queryset = queryset.order_by('-price')
+        if self.request.query_params.get('in_stock') in ('1', 'true'):
+            queryset = queryset.filter(total_stock__gt=0)
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        """
+        Serve the page from the catalog cache and overlay the caller's likes.
+        """
+        def build():
+            if fast_serializers.enabled(request):
+                queryset = fast_serializers.product_values(self.filter_queryset(self.get_queryset()))
+                page = self.paginate_queryset(queryset)
+                return self.get_paginated_response(fast_serializers.products(page, request)).data
+            return super(ProductViewSet, self).list(request, *args, **kwargs).data
+
+        extra = {}
+        if isinstance(self.paginator, ShuffledFeedPagination):
+            extra['seed'] = self.paginator.get_seed(request)
+
+        return catalog_response(request, 'products', build, lambda data: data['results'], **extra)
+
     def retrieve(self, request, *args, **kwargs):
         """
         Override retrieve to get a single product by its ID.
         """
-        product = get_object_or_404(self.queryset, pk=kwargs.get('pk'))
-        serializer = self.get_serializer(product)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        def build():
+            product = get_object_or_404(self.queryset.for_listing(**listing_options(request)), pk=kwargs.get('pk'))
+            return self.get_serializer(product).data
+
+        return catalog_response(request, f"product:{kwargs.get('pk')}", build, lambda data: [data])
 
 
 class CategoryProductListView(generics.RetrieveAPIView):
@@ -90,41 +145,91 @@ class CategoryProductListView(generics.RetrieveAPIView):
     serializer_class = CategorySerializer  # Use an updated serializer
     lookup_field = 'id'
 
+    def get_queryset(self):
+        products = Product.objects.for_listing(**listing_options(self.request))
+        return Category.objects.prefetch_related(Prefetch('products', queryset=products))
+
+    def retrieve(self, request, *args, **kwargs):
+        return catalog_response(
+            request, f"category:{kwargs.get('id')}", lambda: self.get_serializer(self.get_object()).data,
+            lambda data: data['products']
+        )
+
 
 class CategoryListView(generics.ListAPIView):
+    """
+    Category menu with product counts. ?expand=products embeds the products
+    as before (sparse fieldsets apply to them).
+    """
     queryset = Category.objects.all()
-    serializer_class = CategorySerializer
+    serializer_class = CategoryListSerializer
+
+    def expand_products(self):
+        return 'products' in query_list(self.request, 'expand')
+
+    def get_serializer_class(self):
+        return CategorySerializer if self.expand_products() else CategoryListSerializer
+
+    def get_queryset(self):
+        if self.expand_products():
+            products = Product.objects.for_listing(**listing_options(self.request))
+            return Category.objects.prefetch_related(Prefetch('products', queryset=products))
+        return Category.objects.annotate(product_count=Count('products')).order_by('id')
+
+    def list(self, request, *args, **kwargs):
+        def build():
+            return super(CategoryListView, self).list(request, *args, **kwargs).data
+
+        return catalog_response(
+            request, 'categories', build,
+            lambda data: [product for category in data for product in category.get('products', [])]
+        )
 
 
 class LikeProductView(APIView):
     def post(self, request, product_id):
-        userid = request.user.username
-
-        try:
-            product = Product.objects.get(id=product_id)
-        except Product.DoesNotExist:
+        liked = LikeDislike.toggle(request.user.username, product_id)
+        liked_cache.invalidate(request.user.username)
+        if liked is None:
             return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"liked": liked}, status=status.HTTP_200_OK)
 
-        like, created = LikeDislike.objects.get_or_create(product=product, user=userid)
 
-        if not created:
-            like.is_like = not like.is_like
-            like.save()
+class LikeStatusView(APIView):
+    """
+    The user's like flags for up to `max_ids` products at once:
+    ?ids=1,2,3 -> {"liked": {"1": true, "2": false, "3": false}}
+    """
+    max_ids = 100
 
-            if like.is_like:
-                return Response({"liked": True}, status=status.HTTP_200_OK)
-            else:
-                return Response({"liked": False}, status=status.HTTP_200_OK)
-        else:
-            return Response({"liked": True}, status=status.HTTP_201_CREATED)
+    def get(self, request):
+        try:
+            ids = sorted({int(pk) for pk in request.query_params.get('ids', '').split(',') if pk.strip()})
+        except ValueError:
+            return Response({"error": "ids must be a comma-separated list of product ids"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > self.max_ids:
+            return Response({"error": f"At most {self.max_ids} ids at once"}, status=status.HTTP_400_BAD_REQUEST)
+
+        liked = LikeDislike.liked_ids(request.user.username, ids)
+        return Response({"liked": {str(pk): pk in liked for pk in ids}})
 
 
 class LikedProductsView(generics.ListAPIView):
     serializer_class = ProductSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ('id',)
 
     def get_queryset(self):
-        user_id = self.request.user.username
-        return Product.objects.filter(likedislike__user=user_id, likedislike__is_like=True)
+        username = self.request.user.username
+        liked = liked_cache.liked_ids(username, liked_cache.last_toggle(username))
+        return Product.objects.filter(id__in=liked).for_listing(liked=True)
+
+    def list(self, request, *args, **kwargs):
+        if fast_serializers.enabled(request):
+            page = self.paginate_queryset(fast_serializers.product_values(self.get_queryset()))
+            return self.get_paginated_response(fast_serializers.products(page, request))
+        return super().list(request, *args, **kwargs)
 
 
 class AddOrderItemView(APIView):
@@ -139,12 +244,12 @@ class AddOrderItemView(APIView):
             product = Product.objects.get(id=product_id)
             size = ProductSize.objects.get(id=size_id)
 
-            # Check if the requested quantity is available in stock
-            if quantity > size.count:
-                print(quantity)
-                print(size.size, size.count)
+            # Check if the requested quantity is available in stock, other carts' holds included
+            active = Order.objects.filter(user=user, is_paid=False).first()
+            available = size.available_count(exclude_order=active)
+            if quantity > available:
                 return Response(
-                    {"message": "Not enough stock to add this quantity.MF"},
+                    {"message": f"Not enough stock to add this quantity. Only {available} items available."},
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
@@ -213,73 +318,138 @@ class UpdateOrderItemView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class BatchOrderItemsView(APIView):
+    def post(self, request):
+        serializer = BatchOrderItemsSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        order_id = serializer.save().pk
+
+        if fast_serializers.enabled(request):
+            return Response(fast_serializers.order(Order.objects.with_total().get(pk=order_id)),
+                            status=status.HTTP_200_OK)
+        order = Order.objects.with_total().with_items().get(pk=order_id)
+        return Response(OrderSerializer(order).data, status=status.HTTP_200_OK)
+
+
 payme = Payme(payme_id=settings.PAYME_ID)
 
 
+@lru_cache(maxsize=1024)
+def payment_link(order_id, amount, return_url):
+    """Payme checkout link, memoized: it only depends on the order, its total and the return URL."""
+    return payme.initializer.generate_pay_link(id=order_id, amount=amount, return_url=return_url)
+
+
 class GetActiveOrderView(APIView):
     def get(self, request):
         user = request.user
         user_id = user.username
 
+        # Answer conditional requests before loading and serializing the order
+        validators = active_order_validators(user)
+        if validators:
+            order_id, etag, last_modified = validators
+            response = not_modified(request, etag, last_modified)
+            if response is not None:
+                return response
+
         # Fetch the active (not paid) order for the user
+        fast = fast_serializers.enabled(request)
+        orders = Order.objects.with_total() if fast else Order.objects.with_total().with_items()
         try:
-            order = Order.objects.get(user=user, is_paid=False)
+            order = orders.get(user=user, is_paid=False)
         except Order.DoesNotExist:
             return Response({"message": "No active order found."}, status=status.HTTP_404_NOT_FOUND)
 
         # Serialize the order data
-        serializer = OrderSerializer(order)
+        if fast:
+            order_data = fast_serializers.order(order)
+        else:
+            order_data = OrderSerializer(order).data
         result = {
-            'order': serializer.data,
+            'order': order_data,
         }
-        # price_in_tiyins = Decimal(serializer.data['total_price']) * Decimal('100')
-        payment_link = payme.initializer.generate_pay_link(
-            id=serializer.data['id'],
-            amount=serializer.data['total_price'],
-            return_url=f'https://darkslied.pythonanywhere.com/api/login?tg-id={user_id}&name={user.first_name}&p-n={user.last_name}&p-n2={user.email}'  #should be changed after hosting
+        # price_in_tiyins = Decimal(order_data['total_price']) * Decimal('100')
+        result['payment_link'] = payment_link(
+            order_data['id'],
+            order_data['total_price'],
+            f'https://darkslied.pythonanywhere.com/api/login?tg-id={user_id}&name={user.first_name}&p-n={user.last_name}&p-n2={user.email}'  #should be changed after hosting
         )
-        result['payment_link'] = payment_link
-        return Response(result, status=status.HTTP_200_OK)
+        response = Response(result, status=status.HTTP_200_OK)
+        if validators:
+            set_validators(response, etag, last_modified)
+        return response
 
 
 class NotificationListView(generics.ListAPIView):
-    queryset = Notification.objects.all().order_by('-created_at')
+    queryset = Notification.objects.order_by('-created_at')
     serializer_class = NotificationSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-created_at', '-id')
+
+    def get_queryset(self):
+        return super().get_queryset().with_viewed(self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        if fast_serializers.enabled(request):
+            page = self.paginate_queryset(fast_serializers.notification_values(self.get_queryset()))
+            return self.get_paginated_response(fast_serializers.notifications(page, request))
+        return super().list(request, *args, **kwargs)
+
+
+class UnreadNotificationCountView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response({'unread': UnreadNotifications.count_for(request.user)})
+
+
+class MarkAllNotificationsReadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        marked = UnreadNotifications.mark_all_read(request.user)
+        return Response({'marked': marked, 'unread': 0})
 
 
 class PaymeCallBackAPIView(PaymeWebHookAPIView):
     permission_classes = [AllowAny]
 
+    def perform_transaction(self, params):
+        # Retried deliveries are answered from the PaymeEvent ledger
+        if 'id' not in params:
+            return super().perform_transaction(params)
+        return PaymeEvent.process_once(PaymeEvent.PERFORM, params['id'],
+                                       lambda: super(PaymeCallBackAPIView, self).perform_transaction(params))
+
+    def cancel_transaction(self, params):
+        if 'id' not in params:
+            return super().cancel_transaction(params)
+        return PaymeEvent.process_once(PaymeEvent.CANCEL, params['id'],
+                                       lambda: super(PaymeCallBackAPIView, self).cancel_transaction(params))
+
+    # Payme expects a quick answer: the handlers only enqueue work, which
+    # commits together with the PaymeEvent row; app.jobs does the rest.
+
+    def handle_pre_payment(self, params, result, *args, **kwargs):
+        pass
+
     def handle_created_payment(self, params, result, *args, **kwargs):
-        """
-        Handle the successful payment. You can override this method
-        """
-        print(f"Transaction created for this params: {params} and cr_result: {result}")
+        pass
 
     def handle_successfully_payment(self, params, result, *args, **kwargs):
         """
-        Handle the successful payment. You can override this method
+        Queue the stock deduction and customer notification
         """
-        transaction = PaymeTransactions.get_by_transaction_id(
-            transaction_id=params['id']
-        )
-        order = Order.objects.get(id=transaction.account.id)
-        OrderItem.deduct_stock(order)  #this funtion deducts the stock and removes paid items and also marks the order as paid
-
-        print(f"Transaction successfully performed for this params: {params} and performed_result: {result}")
+        Job.enqueue('fulfil_order', transaction_id=params['id'])
 
     def handle_cancelled_payment(self, params, result, *args, **kwargs):
         """
-        Handle the cancelled payment. You can override this method
+        Queue the stock restore. Only a performed transaction took stock; CANCELED_DURING_INIT never did
         """
-        transaction = PaymeTransactions.get_by_transaction_id(
-            transaction_id=params['id']
-        )
-        order = Order.objects.get(id=transaction.account.id)
-        OrderItem.restore_stock(order)  #this function will undo all the works deduct_stock() did
-
-        print(f"Transaction cancelled for this params: {params} and cancelled_result: {result}")
+        if result['result']['state'] == PaymeTransactions.CANCELED:
+            Job.enqueue('refund_order', transaction_id=params['id'])
 
 
 class CheckPaymentStatusView(APIView):
@@ -290,7 +460,7 @@ class CheckPaymentStatusView(APIView):
             return Response({'error': 'Order ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            order = Order.objects.get(id=order_id)
+            order = Order.objects.with_total().get(id=order_id)
         except Order.DoesNotExist:
             return Response({'error': 'Order not found.'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -298,6 +468,38 @@ class CheckPaymentStatusView(APIView):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+async def wait_payment_status(request):
+    """
+    Long-polling version of CheckPaymentStatusView: answers as soon as the
+    order is paid, or with the pending status after `timeout` seconds
+    (default 25) so the client can ask again. Run under ASGI
+    (webproject/asgi.py) so waiting clients don't hold a worker thread.
+    """
+    try:
+        authenticated = await sync_to_async(TokenAuthentication().authenticate)(request)
+    except AuthenticationFailed as exc:
+        return JsonResponse({'detail': exc.detail}, status=status.HTTP_401_UNAUTHORIZED)
+    if authenticated is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                            status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        order_id = int(request.GET['order_id'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Order ID is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        timeout = min(max(float(request.GET.get('timeout', 25)), 0), 55)
+    except ValueError:
+        timeout = 25
+
+    await order_events.wait_until_paid(order_id, timeout)
+
+    order = await sync_to_async(Order.objects.with_total().filter(id=order_id).first)()
+    if order is None:
+        return JsonResponse({'error': 'Order not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse(OrderStatusSerializer(order).data)
+
+
 @api_view(['GET'])
 def get_notification_and_mark_read(request, notification_id):
     # Ensure the user is authenticated
@@ -305,18 +507,17 @@ def get_notification_and_mark_read(request, notification_id):
         return Response({'detail': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
 
     try:
-        # Fetch the notification by ID
-        notification = Notification.objects.get(id=notification_id)
+        # Fetch the notification by ID, with whether the current user has already viewed it
+        notification = Notification.objects.with_viewed(request.user).get(id=notification_id)
     except Notification.DoesNotExist:
         return Response({'detail': 'Notification not found'}, status=status.HTTP_404_NOT_FOUND)
 
-    # Check if the current user has already viewed the notification
-    has_viewed = request.user in notification.viewed_by_user.all()
+    has_viewed = notification.has_viewed
 
     # If not, mark it as viewed by the current user
     if not has_viewed:
         notification.viewed_by_user.add(request.user)
-        notification.save()
+        notification.has_viewed = True
 
     # Return the notification data and whether the user has viewed it
     return Response({
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -132,6 +133,29 @@ REST_FRAMEWORK = {
     ]
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Catalog responses are cached per catalog version, see app/caching.py
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Serve read-only list endpoints from .values() rows instead of the DRF serializers (opt-in with
+# FAST_READ_SERIALIZERS=1), see app/fast_serializers.py
+FAST_READ_SERIALIZERS = os.environ.get('FAST_READ_SERIALIZERS') == '1'
+
+# Seconds a cart line holds its stock, see app.models.StockHold
+STOCK_HOLD_TTL = 15 * 60
+
+# Users whose liked product ids are cached per process, and for how many seconds, see app/liked_cache.py
+LIKED_CACHE_SIZE = 10000
+LIKED_CACHE_TTL = 60
+
+# Seconds between the checks of all long-polled orders of a process (one query each), see app/order_events.py
+PAYMENT_STATUS_POLL = 0.5
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
 
@@ -146,8 +170,6 @@ USE_TZ = False
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
-import os
-
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
@@ -166,3 +188,6 @@ PAYME_ACCOUNT_FIELD = "order_id"
 PAYME_AMOUNT_FIELD = "total_price"
 PAYME_ACCOUNT_MODEL = "app.models.Order"
 PAYME_ONE_TIME_PAYMENT = True
+
+# Bot used by background jobs to message customers, see app/jobs.py
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '')